@@ -3,7 +3,7 @@ import requests
 import json
 import logging
 import pymongo
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne, ReturnDocument
 from bson.objectid import ObjectId
 
 from datetime import datetime, timezone
@@ -12,6 +12,9 @@ from requests_oauthlib import OAuth2Session
 from flask import Flask, render_template, url_for, redirect, g, request, session, send_from_directory, abort, jsonify
 from flask_wtf.csrf import CSRFProtect
 
+from schema import ensure_indexes, ensure_tallies
+from thumbnails import THUMBNAIL_DIR, thumbnail_name
+
 ADMINS = os.environ.get("ADMINS").split(',')
 
 # DATABASE
@@ -29,6 +32,9 @@ REDDIT_REDIRECT_URI = os.environ.get("REDDIT_REDIRECT_URI")
 REDDIT_API_BASE_URL = "https://www.reddit.com/api/v1"
 REDDIT_OAUTH_BASE_URL = "https://oauth.reddit.com/api/v1"
 
+# Thumbnails never change once written, so browsers may keep them for a year
+THUMBNAIL_MAX_AGE = 365 * 24 * 60 * 60
+
 app = Flask(__name__)
 csrf = CSRFProtect(app)
 
@@ -40,6 +46,8 @@ app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'this_should_be_configur
 
 mongo = MongoClient(host=DB_HOST, port=int(DB_PORT), username=DB_USER, password=DB_PASSWORD, authSource=DB_DB, authMechanism='SCRAM-SHA-256')
 db = mongo[DB_DB]
+ensure_indexes(db)
+ensure_tallies(db)
 
 def require_auth(f):
     @wraps(f)
@@ -65,18 +73,21 @@ def home():
         if session.get('user', None) and request.method == 'POST' and request.form.get('vote'):
             vote = request.form.get('vote')
 
-            db.votes.update_one(
+            previous = db.votes.find_one_and_update(
                 {"id": session.get("user")["id"]},
                 {"$set": {"vote": vote}},
-                upsert = True
+                upsert = True,
+                return_document = ReturnDocument.BEFORE
             )
 
+            update_tallies(previous["vote"] if previous else None, vote)
+
         current_vote = db.votes.find_one({"id": session.get("user")["id"]}) if session.get("user") else None
         return render_template('voting.html',
                                 session=session,
                                 admins=ADMINS,
                                 countdown_to=voting_end,
-                                submissions=db.submissions.find({"$query": {}, "$orderby": {"title": pymongo.ASCENDING}}),
+                                submissions=db.submissions.find({"removed": {"$ne": True}}).sort("title", pymongo.ASCENDING),
                                 current_vote=ObjectId(current_vote["vote"]) if current_vote else None
                             )
 
@@ -85,7 +96,7 @@ def home():
                         session=session,
                         admins=ADMINS,
                         countdown_to=voting_start,
-                        winner=db.submissions.find_one({"_id": ObjectId(count_votes()[0]["_id"])})
+                        winner=get_winner()
                     )
 
 @app.route('/login')
@@ -145,14 +156,15 @@ def admin():
             else: return 'Missing required arguments'
 
         elif action == 'remove':
-            db.submissions.delete_one({"_id": ObjectId(_id)})
+            # Only mark it, so the bot's submission sync doesn't add it back
+            db.submissions.update_one({"_id": ObjectId(_id)}, {"$set": {"removed": True}})
 
         else: return 'Undefined action'
 
     votes = {vote["_id"]: vote["count"] for vote in count_votes()}
 
     submissions = []
-    for submission in db.submissions.find({"$query": {}, "$orderby": {"title": pymongo.ASCENDING}}):
+    for submission in db.submissions.find({"removed": {"$ne": True}}).sort("title", pymongo.ASCENDING):
         submission["_id"] = str(submission["_id"])
         submission["score"] = votes[submission["_id"]] if submission["_id"] in votes else 0
         submissions.append(submission)
@@ -162,29 +174,63 @@ def admin():
                             submissions=sorted(submissions, key=lambda k: k['score'], reverse=True)
                         )
 
+@app.route('/thumbnails/<path:filename>')
+def thumbnail(filename):
+    return send_from_directory(THUMBNAIL_DIR, filename, cache_timeout=THUMBNAIL_MAX_AGE)
+
 @app.route('/logout')
 def logout():
     session.clear()
     return redirect(url_for('home'))
 
+def update_tallies(previous, vote):
+    # Moves a vote from the previous choice (None for a first vote) to the new one.
+    # The votes update hands every change of a user's vote out exactly once, so
+    # concurrent votes can't double count. The votes update and this write are
+    # separate though, so the tallies drift if the app dies in between or this
+    # write fails. The bot recounts them before picking the winner, and
+    # `python bot.py tallies` recounts them at any time.
+    if previous == vote:
+        return
+
+    operations = [UpdateOne({"_id": vote}, {"$inc": {"count": 1}}, upsert=True)]
+
+    if previous is not None:
+        operations.append(UpdateOne({"_id": previous}, {"$inc": {"count": -1}}, upsert=True))
+
+    db.tallies.bulk_write(operations, ordered=False)
+
 def count_votes():
-    _votes = db.votes.aggregate([
-        {
-            "$group": {
-                "_id": "$vote",
-                "count": {"$sum": 1}
-            }
-        },
-        {"$sort": { "count": -1}}
-    ])
+    # Vote counts per submission id, most votes first
+    return list(db.tallies.find({"count": {"$gt": 0}}).sort("count", pymongo.DESCENDING))
 
-    return list(_votes)
+def get_winner():
+    # Submissions removed through /admin can't win
+    for vote in count_votes():
+        submission = db.submissions.find_one({"_id": ObjectId(vote["_id"]), "removed": {"$ne": True}})
+        if submission:
+            return submission
 
 def to_json(value):
     return json.dumps(value)
 
 app.jinja_env.filters['to_json'] = to_json
 
+def thumbnail_url(submission, width, ext):
+    return url_for('thumbnail', filename=thumbnail_name(submission["thumbnail"], width, ext))
+
+def thumbnail_srcset(submission, ext):
+    return ', '.join('{} {}w'.format(thumbnail_url(submission, width, ext), width) for width in submission["thumbnail_widths"])
+
+def has_size(submission):
+    # Thumbnails and sizes are only made by the bot, so they lag behind image edits made through /admin
+    return submission.get("width") and submission.get("thumbnail_source") == submission.get("image")
+
+def has_thumbnail(submission):
+    return has_size(submission) and submission.get("thumbnail")
+
+app.jinja_env.globals.update(thumbnail_url=thumbnail_url, thumbnail_srcset=thumbnail_srcset, has_thumbnail=has_thumbnail, has_size=has_size)
+
 def make_reddit_session(token=None, state=None, scope=None):
     return OAuth2Session(
         client_id=REDDIT_APP_ID,
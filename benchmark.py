@@ -0,0 +1,151 @@
+################################################################################
+# ColorCube benchmarks
+#
+# Times construction, reset, find_local_maxima, filter_distinct_maxima and
+# get_colors over a matrix of resolutions, image sizes, alpha and non alpha
+# inputs and synthetic and photo like color distributions. Results are printed
+# (or saved) as JSON, and can be compared against a stored baseline to catch
+# speed regressions and palette changes.
+#
+#   python benchmark.py --save baseline.json
+#   python benchmark.py --baseline baseline.json
+
+import argparse
+import hashlib
+import itertools
+import json
+import sys
+import timeit
+
+import numpy as np
+from PIL import Image
+
+from colorcube import ColorCube
+
+RESOLUTIONS = [10, 30, 64, 128]
+SIZES = [(50, 50), (500, 500), (1920, 416)]
+MODES = ['RGB', 'RGBA']
+DISTRIBUTIONS = ['synthetic', 'photo']
+
+def synthetic_image(size, mode, seed=0):
+    # Uniformly random pixels, the worst case for the number of occupied cells
+    rng = np.random.default_rng(seed)
+    pixels = rng.integers(0, 256, size=(size[1], size[0], len(mode)), dtype=np.uint8)
+
+    return Image.fromarray(pixels, mode)
+
+def photo_image(size, mode, seed=0):
+    # Smooth gradients with a few soft blobs of color and a bit of noise,
+    # which is closer to what real submissions look like
+    rng = np.random.default_rng(seed)
+    width, height = size
+
+    y, x = np.mgrid[0:height, 0:width]
+    y = y / max(height - 1, 1)
+    x = x / max(width - 1, 1)
+
+    # Sky like vertical gradient between two colors
+    top, bottom = rng.uniform(0, 1, 3), rng.uniform(0, 1, 3)
+    pixels = top * (1 - y[..., np.newaxis]) + bottom * y[..., np.newaxis]
+
+    # Blobs
+    for _ in range(6):
+        color = rng.uniform(0, 1, 3)
+        cx, cy, radius = rng.uniform(0, 1), rng.uniform(0, 1), rng.uniform(0.05, 0.3)
+        weight = np.exp(-((x - cx) ** 2 + (y - cy) ** 2) / (2 * radius * radius))[..., np.newaxis]
+        pixels = pixels * (1 - weight) + color * weight
+
+    pixels = pixels + rng.normal(0, 0.02, pixels.shape)
+
+    if mode == 'RGBA':
+        alpha = 0.5 + 0.5 * x[..., np.newaxis]
+        pixels = np.concatenate([pixels, alpha], axis=2)
+
+    return Image.fromarray((np.clip(pixels, 0, 1) * 255).astype(np.uint8), mode)
+
+def best_time(function, repeat):
+    # Returns the fastest of several runs, in seconds
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+def run_case(resolution, size, mode, distribution, repeat):
+    image = (synthetic_image if distribution == 'synthetic' else photo_image)(size, mode)
+    cube = ColorCube(resolution=resolution, avoid_color=[255, 255, 255])
+
+    maxima = cube.find_local_maxima(image)
+    colors = cube.get_colors(image)
+
+    return {
+        'case': '{}x{} {} {} resolution={}'.format(size[0], size[1], mode, distribution, resolution),
+        'resolution': resolution,
+        'size': list(size),
+        'mode': mode,
+        'distribution': distribution,
+        'maxima': len(maxima),
+        'colors': len(colors),
+        'palette': hashlib.sha256(json.dumps(colors).encode()).hexdigest(),
+        'timings': {
+            'construct': best_time(lambda: ColorCube(resolution=resolution), repeat),
+            'reset': best_time(cube.analysis_cells, repeat),
+            'find_local_maxima': best_time(lambda: cube.find_local_maxima(image), repeat),
+            'filter_distinct_maxima': best_time(lambda: cube.filter_distinct_maxima(maxima), repeat),
+            'get_colors': best_time(lambda: cube.get_colors(image), repeat)
+        }
+    }
+
+def compare(results, baseline, tolerance):
+    # Returns a list of problems with the results compared to the baseline
+    problems = []
+    previous = {case['case']: case for case in baseline['cases']}
+
+    for case in results['cases']:
+        if case['case'] not in previous:
+            continue
+
+        before = previous[case['case']]
+
+        if case['palette'] != before['palette']:
+            problems.append('{}: palette changed'.format(case['case']))
+
+        for name, seconds in case['timings'].items():
+            limit = before['timings'].get(name)
+
+            if limit is not None and seconds > limit * (1.0 + tolerance):
+                problems.append('{}: {} took {:.6f}s, baseline {:.6f}s'.format(case['case'], name, seconds, limit))
+
+    return problems
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark ColorCube.')
+    parser.add_argument('--resolutions', type=int, nargs='+', default=RESOLUTIONS, help='Cube resolutions to test.')
+    parser.add_argument('--sizes', nargs='+', default=['{}x{}'.format(*s) for s in SIZES], help='Image sizes to test, as WIDTHxHEIGHT.')
+    parser.add_argument('--modes', nargs='+', default=MODES, choices=MODES, help='Image modes to test.')
+    parser.add_argument('--distributions', nargs='+', default=DISTRIBUTIONS, choices=DISTRIBUTIONS, help='Color distributions to test.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per timing, the fastest is kept.')
+    parser.add_argument('--save', help='Write the results to this JSON file.')
+    parser.add_argument('--baseline', help='Compare the results against this JSON file and fail on regressions.')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown against the baseline (0.25 = 25%%).')
+    args = parser.parse_args()
+
+    sizes = [tuple(int(n) for n in s.split('x')) for s in args.sizes]
+
+    results = {'cases': []}
+    for resolution, size, mode, distribution in itertools.product(args.resolutions, sizes, args.modes, args.distributions):
+        case = run_case(resolution, size, mode, distribution, args.repeat)
+        results['cases'].append(case)
+        print(json.dumps(case), file=sys.stderr)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            problems = compare(results, json.load(f), args.tolerance)
+
+        for problem in problems:
+            print(problem, file=sys.stderr)
+
+        if problems:
+            sys.exit(1)
@@ -1,17 +1,26 @@
 import os
 import re
+import sys
 import praw
+import prawcore
 import calendar
 import requests
 import urllib
+import threading
 
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne, DeleteMany
 from bson.objectid import ObjectId
 
 from io import BytesIO
 from PIL import Image
-from datetime import datetime
-from colorcube import ColorCube
+from time import sleep
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from colorcube import ColorCube, PaletteCache
+from metrics import Metrics
+from ratelimit import Scheduler
+from schema import ensure_indexes, rebuild_tallies, remove_duplicate_votes
+from thumbnails import make_thumbnails
 
 class objdict(dict):
     def __getattr__(self, name):
@@ -43,19 +52,112 @@ REDDIT_CLIENT_REFRESH_TOKEN = os.environ.get("REDDIT_CLIENT_REFRESH_TOKEN")
 
 # IMGUR
 IMGUR_CLIENT_ID = os.environ.get("IMGUR_CLIENT_ID")
+IMGUR_WORKERS = int(os.environ.get("IMGUR_WORKERS", 8))
+IMGUR_TIMEOUT = 10
+IMGUR_RETRIES = 4
+IMGUR_MAX_BACKOFF = 60
+
+# How long resolved image links, and links imgur says don't exist, are remembered
+IMAGE_CACHE_TTL = timedelta(days=int(os.environ.get("IMAGE_CACHE_TTL_DAYS", 60)))
+IMAGE_CACHE_MISSING_TTL = timedelta(days=1)
 
 # SUBREDDIT
 SUBREDDIT = os.environ.get("SUBREDDIT")
 
-mongo = MongoClient(host=DB_HOST, port=int(DB_PORT), username=DB_USER, password=DB_PASSWORD, authSource=DB_DB, authMechanism='SCRAM-SHA-256')
-db = mongo[DB_DB]
+# PALETTE CACHE (optional directory to keep header colors between runs)
+PALETTE_CACHE_DIR = os.environ.get("PALETTE_CACHE_DIR")
+
+# HEADER IMAGE
+HEADER_WIDTH = 1920
+HEADER_HEIGHT = 416
+HEADER_MAX_BYTES = int(os.environ.get("HEADER_MAX_BYTES", 32 * 1024 * 1024))
+HEADER_MAX_PIXELS = int(os.environ.get("HEADER_MAX_PIXELS", 50 * 1000 * 1000))
+HEADER_TIMEOUT = 30
+
+# How much of an image we read to find its dimensions if we can't make thumbnails of it
+PROBE_BYTES = 64 * 1024
+
+# RUN METRICS
+# Every run writes bot.json and bot.prom here, point the Prometheus node exporter's textfile collector at it
+METRICS_DIR = os.environ.get("METRICS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'metrics'))
+
+# Time, calls, bytes, retries and errors of the steps of this run
+metrics = Metrics('lowpoly_bot')
+
+class Lazy:
+    # Stands in for an object that is only made the first time one of its attributes
+    # is used, so importing the bot doesn't connect to anything and a run only
+    # touches the services it needs. configure() can pass the object in instead.
+    def __init__(self, make):
+        self._make = make
+        self._value = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        # The first use can come from several threads at once, only one of them makes it
+        with self._lock:
+            if self._value is None:
+                self._value = self._make()
+
+        return self._value
+
+    def _replace(self, value):
+        self._value = value
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+def connect_db():
+    mongo = MongoClient(host=DB_HOST, port=int(DB_PORT), username=DB_USER, password=DB_PASSWORD, authSource=DB_DB, authMechanism='SCRAM-SHA-256')
+    db = mongo[DB_DB]
+    ensure_indexes(db)
+
+    return db
+
+db = Lazy(connect_db)
+
+# All calls to reddit and imgur wait for their turn here. Reddit gets its 600
+# requests per 10 minutes. Imgur only limits the number of calls per hour, so
+# its bucket refills faster than the workers can make calls. Both follow the
+# quota reported in the rate limit headers of the responses, and only wait
+# once it is used up.
+scheduler = Scheduler({
+    'reddit': (10, 1.0),
+    'imgur': (IMGUR_WORKERS, 50.0)
+})
 
-reddit = praw.Reddit(client_id=REDDIT_CLIENT_ID,
-                     client_secret=REDDIT_CLIENT_SECRET,
-                     refresh_token=REDDIT_CLIENT_REFRESH_TOKEN,
-                     user_agent='/r/low_poly bot by /u/RenegadeAI')
+class ScheduledRequestor(prawcore.Requestor):
+    # Sends every request praw makes through the scheduler
+    def request(self, *args, **kwargs):
+        method = (args[0] if args else kwargs['method']).upper()
+        url = args[1] if len(args) > 1 else kwargs['url']
 
-print('Successfully logged into reddit as {}'.format(reddit.user.me()))
+        # Writes are recorded by endpoint, reads all together
+        name = 'reddit.GET' if method == 'GET' else 'reddit.{} {}'.format(method, urllib.parse.urlparse(url).path.rstrip('/'))
+
+        scheduler.acquire('reddit')
+        with metrics.timer(name):
+            response = super().request(*args, **kwargs)
+        scheduler.limit('reddit', response.headers.get('x-ratelimit-remaining'), response.headers.get('x-ratelimit-reset'))
+
+        return response
+
+def connect_reddit():
+    reddit = praw.Reddit(client_id=REDDIT_CLIENT_ID,
+                         client_secret=REDDIT_CLIENT_SECRET,
+                         refresh_token=REDDIT_CLIENT_REFRESH_TOKEN,
+                         user_agent='/r/low_poly bot by /u/RenegadeAI',
+                         requestor_class=ScheduledRequestor)
+
+    print('Successfully logged into reddit as {}'.format(reddit.user.me()))
+
+    return reddit
+
+reddit = Lazy(connect_reddit)
+
+# Shared by the image resolving threads, so connections to imgur get reused
+http = requests.Session()
+http.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=IMGUR_WORKERS))
 
 FLAIR_LABELS = ['Blender', 'Unity', 'Modo', '3DS Max', 'Cinema 4D', 'Maya', '<other>']
 
@@ -73,24 +175,124 @@ LINKS = [
 
 FOOTER = "  \n&nbsp;\n ___\n [](#BOT_FOOTER)^" + "&#32;|&#32;".join(LINKS).replace(" ", "&#32;")
 
-subreddit = reddit.subreddit(SUBREDDIT)
-
-meta = objdict(db.meta.find_one({}))
-
-now = datetime.utcnow()
-
-monthrange = calendar.monthrange(now.year,now.month)[1]
-month = now.month
-day = now.day
-
-month_name = calendar.month_name[month]
-time = now.time().replace(microsecond=0)
-
-next_month_name = calendar.month_name[month % 12 + 1]
-
-last_month = month - 1 or 12
-last_month_name = calendar.month_name[last_month]
-last_month_year = now.year - 1 if last_month == 12 else now.year
+class SubredditState:
+    # Reads the subreddit settings, stylesheet and link flair templates at most once
+    # per run, and only writes the parts that differ from what is already there
+    def __init__(self, subreddit):
+        self.subreddit = subreddit
+
+        self.current_settings = None
+        self.current_stylesheet = None
+        self.current_link_templates = None
+
+        # Number of writes made and skipped, for the end of run summary
+        self.writes = 0
+        self.skipped = 0
+
+    def settings(self):
+        if self.current_settings is None:
+            self.current_settings = self.subreddit.mod.settings()
+
+        return self.current_settings
+
+    def update_settings(self, **settings):
+        current = self.settings()
+        changed = {key: value for key, value in settings.items() if current.get(key) != value}
+
+        if not changed:
+            self.skipped += 1
+            return
+
+        self.subreddit.mod.update(**changed)
+        current.update(changed)
+        self.writes += 1
+
+    def stylesheet(self):
+        if self.current_stylesheet is None:
+            self.current_stylesheet = self.subreddit.stylesheet().stylesheet
+
+        return self.current_stylesheet
+
+    def update_stylesheet(self, stylesheet):
+        if self.stylesheet() == stylesheet:
+            self.skipped += 1
+            return
+
+        self.subreddit.stylesheet.update(stylesheet)
+        self.current_stylesheet = stylesheet
+        self.writes += 1
+
+    def link_templates(self):
+        if self.current_link_templates is None:
+            self.current_link_templates = [{
+                'id': template['id'],
+                'text': template['text'],
+                'css_class': template['css_class'] or '',
+                'text_editable': template['text_editable']
+            } for template in self.subreddit.flair.link_templates]
+
+        return self.current_link_templates
+
+    def update_link_templates(self, templates):
+        # Makes the link flair templates match the given list of dicts with text, css_class and text_editable.
+        # Templates are compared by position, changed ones are edited in place, so their order is kept.
+        current = self.link_templates()
+        flair = self.subreddit.flair.link_templates
+
+        for position, template in enumerate(templates):
+            if position >= len(current):
+                flair.add(template['text'], css_class=template['css_class'], text_editable=template['text_editable'])
+                self.writes += 1
+                continue
+
+            existing = current[position]
+            if all(existing[key] == template[key] for key in ('text', 'css_class', 'text_editable')):
+                self.skipped += 1
+                continue
+
+            flair.update(existing['id'], template['text'], css_class=template['css_class'], text_editable=template['text_editable'])
+            existing.update(template)
+            self.writes += 1
+
+        for existing in current[len(templates):]:
+            flair.delete(existing['id'])
+            self.writes += 1
+
+        # Templates we added have ids we don't know, read them again if they are needed
+        self.current_link_templates = None if len(templates) > len(current) else current[:len(templates)]
+
+subreddit = Lazy(lambda: reddit.subreddit(SUBREDDIT))
+state = SubredditState(subreddit)
+
+meta = Lazy(lambda: objdict(db.meta.find_one({}) or {}))
+
+def month_dates(now):
+    # The dates the monthly posts are about, for a run at the given time
+    last_month = now.month - 1 or 12
+
+    return objdict({
+        'now': now,
+        'monthrange': calendar.monthrange(now.year, now.month)[1],
+        'month': now.month,
+        'day': now.day,
+        'month_name': calendar.month_name[now.month],
+        'time': now.time().replace(microsecond=0),
+        'next_month_name': calendar.month_name[now.month % 12 + 1],
+        'last_month': last_month,
+        'last_month_name': calendar.month_name[last_month],
+        'last_month_year': now.year - 1 if last_month == 12 else now.year
+    })
+
+dates = Lazy(lambda: month_dates(datetime.utcnow()))
+
+def configure(now=None, **objects):
+    # Passes in the db, reddit or meta to use instead of the ones the bot makes itself,
+    # and the time to run at, e.g. configure(db=MongoClient()['test'], now=datetime(2020, 3, 1))
+    for name, value in objects.items():
+        {'db': db, 'reddit': reddit, 'meta': meta}[name]._replace(value)
+
+    if now is not None:
+        dates._replace(month_dates(now))
 
 def update_meta(data):
     try:
@@ -99,59 +301,231 @@ def update_meta(data):
     except Exception as e:
         print('Error updating meta {}'.format(e))
 
-def upload_submissions():
+def search_submissions(month_name, year):
     # reddit won't fuck off with changing search, so now we have to
     # nake it look ugly and have an identifier in the flair text
     # since they deprecated searching by css class
+    return list(reddit.subreddit("low_poly").search('flair:"*{} {} SUBMISSION"'.format(month_name, year)))
+
+def resolve_images(posts):
+    # Resolve the image links in parallel, map keeps them in the order of the posts
+    with ThreadPoolExecutor(max_workers=IMGUR_WORKERS) as executor:
+        return list(executor.map(resolve_image, posts))
+
+@metrics.timed('upload_submissions')
+def upload_submissions():
+    # Syncs last month's submissions into the database. Submissions are keyed by
+    # their reddit id: new posts are added, posts that are gone are removed, and
+    # existing ones are only touched if their title or link changed on reddit,
+    # so edits made through /admin survive and images are only resolved once.
+    # Safe to run as often as we like.
+    posts = search_submissions(dates.last_month_name, dates.last_month_year)
+
+    # Submissions stored before the sync kept track of reddit ids, titles and links get
+    # their id from the shortlink, and the title and link of their post as it is now, so
+    # they don't look changed. Their title and image may have been edited through /admin,
+    # so those are left alone.
+    posts_by_id = {post.id: post for post in posts}
+    legacy = {"$or": [{"reddit_id": {"$exists": False}}, {"reddit_title": {"$exists": False}}, {"link": {"$exists": False}}]}
+
+    for submission in db.submissions.find(legacy, {"url": 1, "reddit_id": 1}):
+        reddit_id = submission.get("reddit_id") or submission["url"].rsplit('/', 1)[-1]
+        backfill = {"reddit_id": reddit_id}
+
+        if reddit_id in posts_by_id:
+            backfill.update({"reddit_title": posts_by_id[reddit_id].title, "link": posts_by_id[reddit_id].url})
+
+        db.submissions.update_one({"_id": submission["_id"]}, {"$set": backfill})
+
+    existing = {submission["reddit_id"]: submission for submission in db.submissions.find({}, {"reddit_id": 1, "reddit_title": 1, "link": 1})}
+
+    # Only new posts and posts with a changed link need their image resolved
+    changed = [post for post in posts if post.id not in existing or existing[post.id].get("link") != post.url]
+    images = {post.id: image for post, image in zip(changed, resolve_images(changed))}
+
+    operations = []
+    for post in posts:
+        title = re.sub("\[[^]]*\]", '', post.title)
+
+        if post.id not in existing:
+            operations.append(UpdateOne({"reddit_id": post.id}, {"$setOnInsert": {
+                'image': images[post.id],
+                'url': post.shortlink,
+                'title': title,
+                'author': post.author.name,
+                'reddit_title': post.title,
+                'link': post.url
+            }}, upsert=True))
+            continue
+
+        update = {}
+
+        if existing[post.id].get("reddit_title") != post.title:
+            update.update({'title': title, 'reddit_title': post.title})
+
+        if post.id in images:
+            update.update({'image': images[post.id], 'link': post.url})
+
+        if update:
+            operations.append(UpdateOne({"reddit_id": post.id}, {"$set": update}))
+
+    gone = set(existing) - set(post.id for post in posts)
+    if gone:
+        operations.append(DeleteMany({"reddit_id": {"$in": list(gone)}}))
+
+    if operations:
+        result = db.submissions.bulk_write(operations, ordered=False)
+        print('Synced submissions: {} added, {} updated, {} removed'.format(result.upserted_count, result.modified_count, result.deleted_count))
+
+    update_thumbnails()
+
+@metrics.timed('update_thumbnails')
+def update_thumbnails():
+    # Makes thumbnails for submissions whose image doesn't have any yet,
+    # because the submission is new, was relinked or edited through /admin
+    pending = [submission for submission in db.submissions.find({"image": {"$ne": None}}, {"image": 1, "thumbnail_source": 1})
+               if submission.get("thumbnail_source") != submission["image"]]
+
+    with ThreadPoolExecutor(max_workers=IMGUR_WORKERS) as executor:
+        thumbnails = list(executor.map(thumbnail_image, [submission["image"] for submission in pending]))
+
+    for submission, thumbnail in zip(pending, thumbnails):
+        if thumbnail:
+            thumbnail["thumbnail_source"] = submission["image"]
+            db.submissions.update_one({"_id": submission["_id"]}, {"$set": thumbnail})
+
+def thumbnail_image(url):
+    # Returns the thumbnail fields for the image (see make_thumbnails), or None if there are none.
+    # If no thumbnails can be made we still try to get the size, so the gallery can lay it out.
+    url = requests.utils.unquote(url)
+
+    try:
+        data = download(url, step='thumbnails.download')
+
+        with metrics.timer('thumbnails.make'):
+            return make_thumbnails(data)
+
+    except Exception as e:
+        print('ERROR: could not make thumbnails of {}: {}'.format(url, e))
+
+    try:
+        width, height = probe_size(url)
+        return {"thumbnail": None, "width": width, "height": height, "placeholder": None}
+
+    except Exception as e:
+        print('ERROR: could not get the size of {}: {}'.format(url, e))
+
+def probe_size(url):
+    # Returns the dimensions of an image from the start of the file, without downloading the rest
+    with metrics.timer('thumbnails.probe'):
+        response = requests.get(url, stream=True, headers={'User-agent': 'Mozilla/5.0', 'Range': 'bytes=0-{}'.format(PROBE_BYTES - 1)}, timeout=HEADER_TIMEOUT)
+        response.raise_for_status()
+
+        data = response.raw.read(PROBE_BYTES, decode_content=True)
+        metrics.count('thumbnails.probe', 'bytes', len(data))
+
+    return Image.open(BytesIO(data)).size
+
+def prefetch_images():
+    # Resolves the image links of this month's submissions so far, so the
+    # links are already cached when the submissions are synced on day 1
+    resolve_images(search_submissions(dates.month_name, dates.now.year))
+
+def resolve_image(submission):
+    # Like get_image, but any failure (a failed request, or an error or empty album
+    # in the response) only costs this submission its image
+    try:
+        with metrics.timer('get_image'):
+            return get_image(submission)
+
+    except Exception as e:
+        print('ERROR: could not resolve image of {}: {}: {}'.format(submission.shortlink, type(e).__name__, e))
+
+def imgur_get(path):
+    # Calls the imgur API, backing off and retrying while we are rate limited
+    for attempt in range(IMGUR_RETRIES + 1):
+        # Recorded by the type of link, album, gallery or image
+        name = 'imgur.{}'.format(path.split('/')[0])
+
+        scheduler.acquire('imgur')
+        with metrics.timer(name):
+            response = http.get('https://api.imgur.com/3/{}'.format(path), headers={'Authorization': 'Client-ID {}'.format(IMGUR_CLIENT_ID)}, timeout=IMGUR_TIMEOUT)
+        scheduler.limit_until('imgur', response.headers.get('X-RateLimit-UserRemaining'), response.headers.get('X-RateLimit-UserReset'))
+
+        if response.status_code != 429 or attempt == IMGUR_RETRIES:
+            return response
+
+        try:
+            delay = int(response.headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            delay = 2 ** attempt
+
+        print('Rate limited by imgur, retrying {} in {}s'.format(path, delay))
+        metrics.count(name, 'retries')
+        sleep(min(delay, IMGUR_MAX_BACKOFF))
+
+def cache_image(url, image, ttl=IMAGE_CACHE_TTL):
+    try:
+        db.image_cache.replace_one({"_id": url}, {"image": image, "expires": datetime.utcnow() + ttl}, upsert=True)
 
-    submissions = [{
-        'image': get_image(submission),
-        'url': submission.shortlink,
-        'title': re.sub("\[[^]]*\]", '', submission.title),
-        'author': submission.author.name
-    } for submission in reddit.subreddit("low_poly").search('flair:"*{} {} SUBMISSION"'.format(last_month_name, last_month_year))]
+    except Exception as e:
+        print('Error caching image for {}: {}'.format(url, e))
 
-    db.submissions.delete_many({})
-    if submissions: db.submissions.insert_many(submissions)
+    return image
 
 def get_image(submission):
     url = submission.url.replace('http:', 'https:')
 
+    # Links resolved (or found missing) before don't need another round-trip
+    cached = db.image_cache.find_one({"_id": url})
+    if cached:
+        metrics.count('get_image.cached', 'calls')
+        return cached["image"]
+
+    # Status codes of the imgur calls, only a link that is missing everywhere is cached as missing
+    statuses = []
+
     match = re.match('(https?)\:\/\/(www\.)?(?:m\.)?imgur\.com/a/([a-zA-Z0-9]+)(#[0-9]+)?', url)
     if match:
         album_id = match.group(3)
 
-        response = requests.get('https://api.imgur.com/3/album/{}'.format(album_id), headers={'Authorization': 'Client-ID {}'.format(IMGUR_CLIENT_ID)})
+        response = imgur_get('album/{}'.format(album_id))
+        statuses.append(response.status_code)
 
         if response.status_code not in [404, 429, 500]:
-            return response.json()['data']['images'][0]['link']
+            return cache_image(url, response.json()['data']['images'][0]['link'])
 
     match = re.match('^https?://(?:www\.)?imgur\.com/gallery/([a-zA-Z0-9]+)', url)
     if match:
         gallery_id = match.group(1)
 
-        response = requests.get('https://api.imgur.com/3/gallery/{}'.format(gallery_id), headers={'Authorization': 'Client-ID {}'.format(IMGUR_CLIENT_ID)})
+        response = imgur_get('gallery/{}'.format(gallery_id))
+        statuses.append(response.status_code)
 
         if response.status_code not in [404, 429, 500]:
-            return response.json()['data']['link']
+            return cache_image(url, response.json()['data']['link'])
 
     match = re.match(r"(?:https?\:\/\/)?(?:www\.)?(?:m\.)?(?:i\.)?imgur\.com\/([a-zA-Z0-9]+)", url)
     if match:
         image_id = match.group(1)
 
-        response = requests.get('https://api.imgur.com/3/image/{}'.format(image_id), headers={'Authorization': 'Client-ID {}'.format(IMGUR_CLIENT_ID)})
+        response = imgur_get('image/{}'.format(image_id))
+        statuses.append(response.status_code)
 
         if response.status_code not in [404, 429, 500]:
-            return response.json()['data']['link']
+            return cache_image(url, response.json()['data']['link'])
 
     if(url.endswith(tuple(['.png','jpg']))):
         return url
 
+    if statuses and all(status == 404 for status in statuses):
+        cache_image(url, None, IMAGE_CACHE_MISSING_TTL)
+
 def update_flairs():
-    subreddit.flair.link_templates.clear()
+    templates = []
 
     # This is ugly but it works so fuck it
-    for label in FLAIR_LABELS + ['{} \\\\ {} {} SUBMISSION'.format(label, month_name , now.year) for label in FLAIR_LABELS]:
+    for label in FLAIR_LABELS + ['{} \\\\ {} {} SUBMISSION'.format(label, dates.month_name , dates.now.year) for label in FLAIR_LABELS]:
         css = label.lower().split(' ')[0]
         editable = False
 
@@ -159,7 +533,9 @@ def update_flairs():
             css = ''
             editable = True
 
-        subreddit.flair.link_templates.add(label, css_class=css, text_editable=editable)
+        templates.append({'text': label, 'css_class': css, 'text_editable': editable})
+
+    state.update_link_templates(templates)
 
 def get_monthly_theme():
         submission = reddit.submission(meta.theme_voting)
@@ -168,17 +544,27 @@ def get_monthly_theme():
         return sorted(submission.comments, key=lambda k: k.score, reverse=True)[0]
 
 def get_winner():
-    winner = db.votes.aggregate([
-        {
-            "$group": {
-                "_id": "$vote",
-                "count": {"$sum": 1}
-            }
-        },
-        {"$sort": { "count": -1}}
-    ])
-
-    return objdict(db.submissions.find_one({"_id": ObjectId(list(winner)[0]["_id"])}))
+    # The web app keeps a count of the votes per submission in db.tallies
+    winner = db.tallies.find({"count": {"$gt": 0}}).sort("count", -1)
+
+    # Submissions removed through /admin can't win
+    for vote in winner:
+        submission = db.submissions.find_one({"_id": ObjectId(vote["_id"]), "removed": {"$ne": True}})
+        if submission:
+            return objdict(submission)
+
+def recount_tallies():
+    # Counts the votes again and makes db.tallies match, see schema.rebuild_tallies
+    result = rebuild_tallies(db)
+    print('Rebuilt tallies: {} added, {} corrected, {} removed'.format(result.upserted_count, result.modified_count, result.deleted_count))
+
+def dedupe_votes():
+    # Removes duplicate votes left over from before votes were unique per user,
+    # then makes the unique index and recounts the tallies
+    print('Removed {} duplicate votes'.format(remove_duplicate_votes(db)))
+
+    ensure_indexes(db)
+    recount_tallies()
 
 def substitute_content(original_content, new, marker):
     content = re.sub(r'(\[\]\(#' + marker + '\)).*(\[\]\(/' + marker + '\))', '\\1\\2', original_content, flags=re.DOTALL)
@@ -228,33 +614,80 @@ def colorscale(hexstr, scalefactor):
 
     return "#%02x%02x%02x" % (int(r), int(g), int(b))
 
+def download_image(url, max_bytes=HEADER_MAX_BYTES, step='download'):
+    # Downloads an image, refusing anything bigger than max_bytes.
+    # Only the header is parsed here, the pixels are decoded when they are used.
+    return Image.open(BytesIO(download(url, max_bytes, step)))
+
+def download(url, max_bytes=HEADER_MAX_BYTES, step='download'):
+    # Downloads a file, refusing anything bigger than max_bytes.
+    # The time and bytes are recorded under step.
+    with metrics.timer(step):
+        response = requests.get(url, stream=True, headers={'User-agent': 'Mozilla/5.0'}, timeout=HEADER_TIMEOUT)
+        response.raise_for_status()
+
+        if int(response.headers.get('Content-Length') or 0) > max_bytes:
+            raise ValueError('Image {} is larger than {} bytes'.format(url, max_bytes))
+
+        data = response.raw.read(max_bytes + 1, decode_content=True)
+        metrics.count(step, 'bytes', len(data))
+
+        if len(data) > max_bytes:
+            raise ValueError('Image {} is larger than {} bytes'.format(url, max_bytes))
+
+    return data
+
+def make_header(image):
+    # The header is the band of 416 rows around the middle of the image (260 rows up),
+    # stretched to 1920px wide. Rows outside of the image stay black.
+
+    # Images that are too big to decode are reduced while decoding if the format
+    # allows it (JPEG), otherwise we give up before spending the memory
+    if image.size[0] * image.size[1] > HEADER_MAX_PIXELS:
+        # JPEG can decode at 1/2, 1/4 or 1/8 of the size, ask for the smallest reduction that fits
+        for reduce in (2, 4, 8):
+            if (image.size[0] // reduce) * (image.size[1] // reduce) <= HEADER_MAX_PIXELS:
+                break
+
+        image.draft('RGB', (image.size[0] // reduce, image.size[1] // reduce))
+
+        if image.size[0] * image.size[1] > HEADER_MAX_PIXELS:
+            raise ValueError('Image of {}x{} pixels is too large for the header'.format(*image.size))
+
+    width, height = image.size
+    top = int(height / 2) - 260
+
+    # Crop to the rows we need before resampling. Only the width is scaled,
+    # so every row is resampled on its own and cropping first changes nothing.
+    rows = image.crop((0, max(top, 0), width, min(top + HEADER_HEIGHT, height))).convert('RGB')
+    rows = rows.resize((int(width * (HEADER_WIDTH / width)), rows.size[1]), Image.LANCZOS)
+
+    header_image = Image.new('RGB', (HEADER_WIDTH, HEADER_HEIGHT))
+    header_image.paste(rows, (0, max(-top, 0)))
+
+    return header_image
+
 def update_theme(winner):
-    new_sidebar = substitute_content(subreddit.mod.settings()['description'],
+    new_sidebar = substitute_content(state.settings()['description'],
                                     (
                                        "\n"
                                        "> *{0} monthly winner:*  \n"
                                        "[{1.title:.30}]({2}) by /u/{1.author}\n"
                                        "\n"
-                                    ).format(last_month_name, winner, requests.utils.unquote(winner.url)),
+                                    ).format(dates.last_month_name, winner, requests.utils.unquote(winner.url)),
                                     'BOTWINNER'
                                 )
 
-    subreddit.mod.update(description=new_sidebar)
+    state.update_settings(description=new_sidebar)
 
     #################################################################
     # Download the winner image, resize it, and upload it to reddit
     #################################################################
 
-    response = requests.get(requests.utils.unquote(winner.image), stream=True, headers={'User-agent': 'Mozilla/5.0'})
-    response.raw.decode_content = True
-
-    header_image = Image.open(response.raw).convert('RGB')
+    image = download_image(requests.utils.unquote(winner.image), step='header.download')
 
-    ratio = 1920 / header_image.size[0]
-
-    header_image = header_image.resize((int(header_image.size[0] * ratio), header_image.size[1] * 1), Image.ANTIALIAS)
-    top = int(header_image.size[1] / 2) - 260
-    header_image = header_image.crop((0, top, 1920, top + 416))
+    with metrics.timer('header.resize'):
+        header_image = make_header(image)
 
     # If we just use im.tostring() we get a massive image that won't upload
     def toJPEG(im):
@@ -264,6 +697,9 @@ def update_theme(winner):
 
     # PRAW doesn't support raw image uploads so we will do it ourselves
     # https://github.com/praw-dev/praw/blob/a75ebcf934fb49a6966a04d172fa00e957836958/praw/models/reddit/subreddit.py#L1874
+    with metrics.timer('header.jpeg'):
+        jpeg = toJPEG(header_image)
+
     url = praw.const.API_PATH['upload_image'].format(subreddit=subreddit.display_name)
     subreddit._reddit.post(url,
                            data={
@@ -271,15 +707,17 @@ def update_theme(winner):
                                'upload_type': 'img',
                                'img_type': 'jpg'
                            },
-                           files={'file': toJPEG(header_image)})
+                           files={'file': jpeg})
 
     #################################################################
     #Calulate colors, and upload the custom stylesheet bit
     #################################################################
 
     cc = ColorCube(avoid_color=[255, 255, 255], distinct_threshold=0.8)
-    image = header_image.resize((50, 50))
-    primary = '#%02x%02x%02x' % tuple(cc.get_colors(image)[0])
+    with metrics.timer('colorcube.sample_colors'):
+        colors, stability = PaletteCache(cc, path=PALETTE_CACHE_DIR).sample_colors(header_image)
+    print('Header colors sampled with stability {:.2f}'.format(stability))
+    primary = '#%02x%02x%02x' % tuple(colors[0])
 
     bot_style = (
         ".side .titlebox .md h3 a, .drop-choices a.choice:hover, .submit-page #newlink.submit.content ul.tabmenu.formtab,"
@@ -310,81 +748,223 @@ def update_theme(winner):
                                 'active': colorscale(primary, .75),
                             }))
 
-    stylesheet = substitute_content(subreddit.stylesheet().stylesheet,
+    stylesheet = substitute_content(state.stylesheet(),
                                     bot_style,
                                     'POLYGONAUTOMATON'
                                 )
 
-    subreddit.stylesheet.update(stylesheet)
+    state.update_stylesheet(stylesheet)
+
+#################################################################
+# Monthly phases
+#
+# Each phase is a list of named steps. Finished steps are checkpointed in
+# db.meta together with their output, so rerunning a phase that failed
+# halfway skips the steps that already went through and carries on from
+# the one that failed. Steps that post to reddit are kept apart from the
+# steps that moderate those posts, so a rerun never posts twice.
+#################################################################
+
+STEPS = {}
+
+def step(name):
+    def register(f):
+        STEPS[name] = f
+        return f
+    return register
+
+@step('post_theme_voting')
+def post_theme_voting(outputs):
+    submission = subreddit.submit("{} theme voting".format(dates.next_month_name),
+                                  selftext = ("Hello everyone, please comment your suggestion for next months theme.\n\n"
+                                              "The deadline for voting will be the end of {0} {1}.\n\n"
+                                              "Please limit your response to only your theme idea, I am not a smart bot."
+                                              + FOOTER
+                                             ).format(dates.month_name, dates.monthrange)
+                      )
+
+    update_meta({'theme_voting': submission.id})
+
+    return {'theme_voting': submission.id}
+
+@step('sticky_theme_voting')
+def sticky_theme_voting(outputs):
+    submission = reddit.submission(outputs['theme_voting'])
+    submission.mod.contest_mode()
+    submission.mod.sticky()
+
+@step('close_theme_voting')
+def close_theme_voting(outputs):
+    # These don't depend on each other, so one failing doesn't stop the others.
+    # They go out one after another, praw clients can't be shared between threads.
+    for action in [
+        lambda: reddit.submission(meta.monthly_winner).mod.sticky(state=False),
+        lambda: reddit.submission(meta.theme_voting).mod.sticky(state=False),
+        lambda: reddit.submission(meta.theme_voting).mod.lock()
+    ]:
+        try:
+            action()
 
-if __name__ == '__main__':
-    if(day == monthrange - 7):
-        submission = subreddit.submit("{} theme voting".format(next_month_name),
-                                      selftext = ("Hello everyone, please comment your suggestion for next months theme.\n\n"
-                                                  "The deadline for voting will be the end of {0} {1}.\n\n"
-                                                  "Please limit your response to only your theme idea, I am not a smart bot."
-                                                  + FOOTER
-                                                 ).format(month_name, monthrange)
-                          )
+        except Exception as e:
+            print('ERROR: {}'.format(e))
 
-        submission.mod.contest_mode()
-        submission.mod.sticky()
+@step('sync_submissions')
+def sync_submissions(outputs):
+    upload_submissions()
 
-        update_meta({'theme_voting': submission.id})
+@step('post_voting')
+def post_voting(outputs):
+    submission = subreddit.submit("{} voting now open! Click here to pick your favourite submission!".format(dates.last_month_name),
+                                  url = "https://lowpoly.derw.xyz/"
+                                  )
 
-    elif(day == 1):
-        try:
-            reddit.submission(meta.monthly_winner).mod.sticky(state=False)
-            reddit.submission(meta.theme_voting).mod.sticky(state=False)
-            reddit.submission(meta.theme_voting).mod.lock()
+    update_meta({'voting': submission.id})
 
-        except Exception as e:
-            print('ERROR: {}'.format(e))
+    return {'voting': submission.id}
+
+@step('sticky_voting')
+def sticky_voting(outputs):
+    reddit.submission(outputs['voting']).mod.sticky()
+
+@step('post_theme')
+def post_theme(outputs):
+    winner_comment = get_monthly_theme()
 
-        upload_submissions()
+    submission = subreddit.submit("{0} monthly theme: {1}".format(dates.month_name, winner_comment.body),
+                                  selftext = (
+                                      "This months theme is {0.body} as suggested by /u/{0.author}\n"
+                                      "\n"
+                                      "Submissions will be due at the end of the month"
+                                      + FOOTER
+                                      ).format(winner_comment)
+                                  )
 
-        submission = subreddit.submit("{} voting now open! Click here to pick your favourite submission!".format(last_month_name),
-                                      url = "https://lowpoly.derw.xyz/"
-                                      )
-        submission.mod.sticky()
+    update_meta({'theme': submission.id})
 
-        update_meta({'voting': submission.id})
+    return {'theme': submission.id}
 
-        winner_comment = get_monthly_theme()
+@step('sticky_theme')
+def sticky_theme(outputs):
+    reddit.submission(outputs['theme']).mod.sticky()
 
-        submission = subreddit.submit("{0} monthly theme: {1}".format(month_name, winner_comment.body),
-                                      selftext = (
-                                          "This months theme is {0.body} as suggested by /u/{0.author}\n"
+@step('update_flairs')
+def update_flairs_step(outputs):
+    update_flairs()
+
+@step('post_winner')
+def post_winner(outputs):
+    # Voting is closed by now, so the tallies can be recounted safely, in case they drifted
+    recount_tallies()
+
+    winner = get_winner()
+    if winner is None:
+        raise ValueError('There is no winner, none of the submissions that weren\'t removed got a vote')
+
+    submission = subreddit.submit("{0} monthly winner: {1}".format(dates.last_month_name, winner.author),
+                                  selftext = (
+                                          "Thanks to everyone who participated in last month's challenge.\n"
                                           "\n"
-                                          "Submissions will be due at the end of the month"
+                                          "{0}'s winner is /u/{1.author}, with their submission: [{1.title}]({2})"
                                           + FOOTER
-                                          ).format(winner_comment)
-                                      )
+                                      ).format(dates.last_month_name, winner, requests.utils.unquote(winner.url))
+                                 )
 
-        submission.mod.sticky()
+    update_meta({'monthly_winner': submission.id})
 
-        update_meta({'theme': submission.id})
+    return {'monthly_winner': submission.id, 'winner': str(winner._id)}
 
-        update_flairs()
+@step('sticky_winner')
+def sticky_winner(outputs):
+    try:
+        reddit.submission(outputs['monthly_winner']).mod.sticky(bottom=False)
 
-    elif(day == 8):
-        winner = get_winner()
+    except Exception as e:
+        print('ERROR: {}'.format(e))
 
-        submission = subreddit.submit("{0} monthly winner: {1}".format(last_month_name, winner.author),
-                                      selftext = (
-                                              "Thanks to everyone who participated in last month's challenge.\n"
-                                              "\n"
-                                              "{0}'s winner is /u/{1.author}, with their submission: [{1.title}]({2})"
-                                              + FOOTER
-                                          ).format(last_month_name, winner, requests.utils.unquote(winner.url))
-                                     )
+@step('update_theme')
+def update_theme_step(outputs):
+    update_theme(objdict(db.submissions.find_one({"_id": ObjectId(outputs['winner'])})))
 
-        try:
-            submission.mod.sticky(bottom=False)
+PHASES = {
+    'theme_voting': ['post_theme_voting', 'sticky_theme_voting'],
+    'day_1': ['close_theme_voting', 'sync_submissions', 'post_voting', 'sticky_voting', 'post_theme', 'sticky_theme', 'update_flairs'],
+    'day_8': ['post_winner', 'sticky_winner', 'update_theme']
+}
 
-        except Exception as e:
-            print('ERROR: {}'.format(e))
+def run_phase(phase, only=None):
+    # Runs the steps of the phase that haven't finished this month yet.
+    # With only, runs just that step, even if it finished before.
+    key = '{}:{}-{:02d}'.format(phase, dates.now.year, dates.month)
+    checkpoints = meta.get('checkpoints', {}).get(key, {})
+
+    # Outputs of earlier steps, for the steps that need them
+    outputs = {}
+
+    for name in PHASES[phase]:
+        if name in checkpoints and only != name:
+            outputs.update(checkpoints[name]['output'])
+            print('Skipping {}, done at {}'.format(name, checkpoints[name]['done']))
+            continue
+
+        if only and only != name:
+            continue
+
+        print('Running {}'.format(name))
+        with metrics.timer('step.{}'.format(name)):
+            output = STEPS[name](outputs) or {}
+        outputs.update(output)
 
-        update_meta({'monthly_winner': submission.id})
+        save_checkpoint(key, name, output)
 
-        update_theme(winner)
+def save_checkpoint(key, name, output):
+    # Records that the step finished. Unlike update_meta this fails loudly: a step
+    # that isn't recorded runs again on the next run, and posts its submission twice.
+    db.meta.update_one({}, {"$set": {'checkpoints.{}.{}'.format(key, name): {'done': datetime.utcnow(), 'output': output}}}, upsert=True)
+
+def current_phase():
+    if(dates.day == dates.monthrange - 7):
+        return 'theme_voting'
+
+    if(dates.day == 1):
+        return 'day_1'
+
+    if(dates.day == 8):
+        return 'day_8'
+
+if __name__ == '__main__':
+    # python bot.py                                    runs the phase for today, if any
+    # python bot.py day_1                              runs (or resumes) a phase
+    # python bot.py day_1 post_theme                   runs one step of a phase, even if it finished before
+    # python bot.py sync|prefetch|tallies|dedupe_votes runs a job outside of the phases
+    args = sys.argv[1:]
+
+    try:
+        if args and args[0] in ('sync', 'prefetch', 'tallies', 'dedupe_votes'):
+            {
+                'sync': upload_submissions,
+                'prefetch': prefetch_images,
+                'tallies': recount_tallies,
+                'dedupe_votes': dedupe_votes
+            }[args[0]]()
+
+        elif args:
+            run_phase(args[0], args[1] if len(args) > 1 else None)
+
+        elif current_phase():
+            run_phase(current_phase())
+
+    finally:
+        # Failed runs are reported too, they are the ones we want to look at
+        print('Subreddit writes: {} made, {} skipped as unchanged'.format(state.writes, state.skipped))
+
+        services = scheduler.report()
+        for service, stats in services.items():
+            print('{}: {calls} calls, {waited:.1f}s waiting for quota, {remaining} remaining'.format(service, **stats))
+
+            metrics.count('quota.{}'.format(service), 'calls', stats['calls'])
+            metrics.count('quota.{}'.format(service), 'seconds', stats['waited'])
+
+        metrics.write(os.path.join(METRICS_DIR, 'bot.json'), os.path.join(METRICS_DIR, 'bot.prom'),
+                      command=args or [current_phase()],
+                      services=services,
+                      subreddit={'writes': state.writes, 'skipped': state.skipped})
@@ -22,11 +22,22 @@
 
 from PIL import Image
 
+import hashlib
+import json
 import math
+import os
+import threading
+import time
+import numpy as np
+from collections import OrderedDict
+from io import BytesIO
+from multiprocessing import Pool
 
 class LocalMaximum:
     # Local maxima as found during the image analysis.
     # We need this class for ordering by cell hit count.
+    __slots__ = ('hit_count', 'cell_index', 'r', 'g', 'b')
+
     def __init__(self, hit_count, cell_index, r, g, b):
         # Hit count of the cell
         self.hit_count = hit_count
@@ -37,20 +48,286 @@ class LocalMaximum:
         self.g = g
         self.b = b
 
-class CubeCell:
-    # The color cube is made out of these cells
-    def __init__(self):
-        # Count of hits (dividing the accumulators by this value gives the average color)
-        self.hit_count = 0
-        # Accumulators for color components
-        self.r_acc = 0.0
-        self.g_acc = 0.0
-        self.b_acc = 0.0
+# Minimum distance between a color and the avoid color
+AVOID_DISTANCE = 0.5
+
+# Color grids compare with every color instead of looking at the buckets around it when
+# the buckets are this wide or wider, so there are only a few of them per axis, and
+# while they hold fewer colors than GRID_MIN_COLORS. Both make the linear scan cheaper.
+GRID_MAX_DISTANCE = 0.2
+GRID_MIN_COLORS = 16
+
+# Offsets of a grid bucket and its 26 neighbours
+BUCKET_OFFSETS = [(r, g, b) for r in (-1, 0, 1) for g in (-1, 0, 1) for b in (-1, 0, 1)]
+
+class ColorGrid:
+    # Spatial lookup for colors in RGB space. Colors are put into buckets of a uniform
+    # grid whose buckets are (a bit more than) the search distance wide, so a color can
+    # only be near colors in the 3x3x3 buckets around its own.
+    def __init__(self, distance):
+        self.distance = distance
+        self.bucket_size = distance * (1.0 + 1e-9)
+        self.colors = []
+        self.buckets = {}
+
+    def bucket(self, r, g, b):
+        return (math.floor(r / self.bucket_size), math.floor(g / self.bucket_size), math.floor(b / self.bucket_size))
+
+    def add(self, m):
+        # Adds a color with r, g and b attributes
+        if self.distance <= 0:
+            return
+
+        self.colors.append(m)
+
+        if self.distance < GRID_MAX_DISTANCE:
+            self.buckets.setdefault(self.bucket(m.r, m.g, m.b), []).append(m)
+
+    def bucket_colors(self, m):
+        # Returns the added colors in the 3x3x3 buckets around the color m
+        r, g, b = self.bucket(m.r, m.g, m.b)
+        buckets = self.buckets
+
+        return [n for r_offset, g_offset, b_offset in BUCKET_OFFSETS
+                for n in buckets.get((r + r_offset, g + g_offset, b + b_offset), ())]
+
+    def has_near(self, m):
+        # Checks if any added color is closer to the color m than the distance
+        distance = self.distance
+        if distance <= 0:
+            return False
+
+        colors = self.colors
+        if distance < GRID_MAX_DISTANCE and len(colors) >= GRID_MIN_COLORS:
+            colors = self.bucket_colors(m)
+
+        for n in colors:
+            # Compute delta components
+            r_delta = m.r - n.r
+            g_delta = m.g - n.g
+            b_delta = m.b - n.b
+
+            # Compute delta in color space distance
+            delta = math.sqrt(r_delta*r_delta + g_delta*g_delta + b_delta*b_delta)
+
+            if delta < distance:
+                return True
+
+        return False
+
+# Resolutions above this use sparse cells unless told otherwise
+SPARSE_RESOLUTION = 64
+
+# Number of local maxima created at once when iterating over them
+MAXIMA_BLOCK = 64
+
+# Default pixel budget of sampled analysis, and the number of passes it is split into
+SAMPLE_PIXELS = 65536
+SAMPLE_PASSES = 4
+
+# Number of top colors checked for stability in sampled analysis,
+# and how far (in 0-1 color space) they may move between passes to count as stable
+SAMPLE_TOP = 4
+STABLE_DISTANCE = 0.05
+
+# Offsets of the 26 neighbours of a cell in the three dimensional grid
+NEIGHBOUR_OFFSETS = [(r, g, b) for r in (-1, 0, 1) for g in (-1, 0, 1) for b in (-1, 0, 1) if (r, g, b) != (0, 0, 0)]
+
+# Color cube used by each worker process of ColorCube.get_colors_many
+_worker_cube = None
+
+def _init_worker(settings):
+    global _worker_cube
+    _worker_cube = ColorCube(**settings)
+
+def _job_colors(cube, job):
+    # Returns (colors, error) for an (item, size, error) job, see ColorCube.image_job
+    item, size, error = job
+
+    if error:
+        return None, error
+
+    try:
+        return cube.get_colors(cube.open_item(item, size)), None
+
+    except Exception as e:
+        return None, '{}: {}'.format(type(e).__name__, e)
+
+def _worker_colors(job):
+    return _job_colors(_worker_cube, job)
+
+class CubeCells:
+    # Base class for the cell storage of a color cube.
+    # Cells are addressed by linear index and hold a hit count (dividing the
+    # accumulators by this value gives the average color) and color accumulators.
+    def __init__(self, resolution):
+        self.resolution = resolution
+        self.cell_count = resolution * resolution * resolution
+        self.clear()
+
+    def cell_index(self, r, g, b):
+        # Returns linear index for cell with given 3d index
+        return (r+g*self.resolution+b*self.resolution*self.resolution)
+
+    def make_maxima(self, index, hit_counts, r_acc, g_acc, b_acc):
+        # Yields cells given in r, g, b scan order as local maxima sorted with respect to hit count.
+        # The sort is stable, so cells with equal hit counts stay in scan order.
+        order = np.argsort(-hit_counts, kind='stable')
+        hit_counts = hit_counts[order]
+
+        index = index[order]
+
+        # Average color of each maximum cell
+        avg_r = r_acc[order] / hit_counts
+        avg_g = g_acc[order] / hit_counts
+        avg_b = b_acc[order] / hit_counts
+
+        # Create the maxima a block at a time, so callers that stop early don't pay for all of them
+        for start in range(0, len(index), MAXIMA_BLOCK):
+            block = slice(start, start + MAXIMA_BLOCK)
+            for m in zip(hit_counts[block].tolist(), index[block].tolist(), avg_r[block].tolist(), avg_g[block].tolist(), avg_b[block].tolist()):
+                yield LocalMaximum(*m)
+
+class DenseCells(CubeCells):
+    # Stores every cell of the cube, one array per field indexed by linear cell index
+    def clear(self):
+        if not hasattr(self, 'hit_counts'):
+            self.hit_counts = np.zeros(self.cell_count, dtype=np.int64)
+            self.r_acc = np.zeros(self.cell_count)
+            self.g_acc = np.zeros(self.cell_count)
+            self.b_acc = np.zeros(self.cell_count)
+            return
+
+        self.hit_counts.fill(0)
+        self.r_acc.fill(0.0)
+        self.g_acc.fill(0.0)
+        self.b_acc.fill(0.0)
+
+    def add(self, index, colors):
+        # Adds pixels with the given linear cell indices and (n, 3) colors
+        self.hit_counts += np.bincount(index, minlength=self.cell_count)
+        self.r_acc += np.bincount(index, weights=colors[:, 0], minlength=self.cell_count)
+        self.g_acc += np.bincount(index, weights=colors[:, 1], minlength=self.cell_count)
+        self.b_acc += np.bincount(index, weights=colors[:, 2], minlength=self.cell_count)
+
+    def add_cells(self, cell_indices, hit_counts, r_acc, g_acc, b_acc):
+        # Adds hits and colors to the cells with the given unique linear indices
+        self.hit_counts[cell_indices] += hit_counts
+        self.r_acc[cell_indices] += r_acc
+        self.g_acc[cell_indices] += g_acc
+        self.b_acc[cell_indices] += b_acc
+
+    def occupied(self):
+        # Returns linear indices, hit counts and color accumulators of all cells with hits
+        cell_indices = np.flatnonzero(self.hit_counts)
+        return cell_indices, self.hit_counts[cell_indices], self.r_acc[cell_indices], self.g_acc[cell_indices], self.b_acc[cell_indices]
+
+    def iter_local_maxima(self):
+        resolution = self.resolution
+
+        # View hit counts as a grid indexed by [r, g, b]
+        grid = self.hit_counts.reshape(resolution, resolution, resolution).transpose(2, 1, 0)
+
+        # Get the highest hit count in the 3x3x3 neighbourhood of each cell.
+        # Cells outside of the cube count as zero hits, so they never beat a hit cell.
+        # The neighbourhood is a box, so we can take the maximum one axis at a time.
+        neighbourhood = np.pad(grid, 1)
+        neighbourhood = np.maximum(np.maximum(neighbourhood[:-2], neighbourhood[1:-1]), neighbourhood[2:])
+        neighbourhood = np.maximum(np.maximum(neighbourhood[:, :-2], neighbourhood[:, 1:-1]), neighbourhood[:, 2:])
+        neighbourhood = np.maximum(np.maximum(neighbourhood[:, :, :-2], neighbourhood[:, :, 1:-1]), neighbourhood[:, :, 2:])
+
+        # A cell with hits is a local maximum if no neighbour has a higher hit count
+        r, g, b = np.nonzero((grid > 0) & (grid >= neighbourhood))
+        index = self.cell_index(r, g, b)
+
+        return self.make_maxima(index, self.hit_counts[index], self.r_acc[index], self.g_acc[index], self.b_acc[index])
+
+class SparseCells(CubeCells):
+    # Stores only cells with hits, as arrays sorted by linear cell index
+    def clear(self):
+        self.cell_indices = np.zeros(0, dtype=np.intp)
+        self.hit_counts = np.zeros(0, dtype=np.int64)
+        self.r_acc = np.zeros(0)
+        self.g_acc = np.zeros(0)
+        self.b_acc = np.zeros(0)
+
+    def add(self, index, colors):
+        # Adds pixels with the given linear cell indices and (n, 3) colors
+
+        # Sum up hits and colors of the cells these pixels fall into
+        cell_indices, inverse = np.unique(index, return_inverse=True)
+        hit_counts = np.bincount(inverse, minlength=len(cell_indices))
+        r_acc = np.bincount(inverse, weights=colors[:, 0], minlength=len(cell_indices))
+        g_acc = np.bincount(inverse, weights=colors[:, 1], minlength=len(cell_indices))
+        b_acc = np.bincount(inverse, weights=colors[:, 2], minlength=len(cell_indices))
+
+        self.add_cells(cell_indices, hit_counts, r_acc, g_acc, b_acc)
+
+    def add_cells(self, cell_indices, hit_counts, r_acc, g_acc, b_acc):
+        # Adds hits and colors to the cells with the given unique, sorted linear indices
+        if len(self.cell_indices) == 0:
+            self.cell_indices, self.hit_counts, self.r_acc, self.g_acc, self.b_acc = cell_indices, hit_counts, r_acc, g_acc, b_acc
+            return
+
+        # Merge them with the cells we already have
+        merged = np.union1d(self.cell_indices, cell_indices)
+        old = np.searchsorted(merged, self.cell_indices)
+        new = np.searchsorted(merged, cell_indices)
+
+        for field, values in (('hit_counts', hit_counts), ('r_acc', r_acc), ('g_acc', g_acc), ('b_acc', b_acc)):
+            merged_values = np.zeros(len(merged), dtype=values.dtype)
+            merged_values[old] = getattr(self, field)
+            merged_values[new] += values
+            setattr(self, field, merged_values)
+
+        self.cell_indices = merged
+
+    def occupied(self):
+        # Returns linear indices, hit counts and color accumulators of all cells with hits
+        return self.cell_indices, self.hit_counts, self.r_acc, self.g_acc, self.b_acc
+
+    def iter_local_maxima(self):
+        resolution = self.resolution
+        cell_indices = self.cell_indices
+        hit_counts = self.hit_counts
+
+        if len(cell_indices) == 0:
+            return iter(())
+
+        # Get 3d indices of the occupied cells
+        r = cell_indices % resolution
+        g = cell_indices // resolution % resolution
+        b = cell_indices // (resolution * resolution)
+
+        # It is a local maximum until we find an occupied neighbour with a higher hit count
+        is_local_maximum = np.ones(len(cell_indices), dtype=bool)
+
+        for r_offset, g_offset, b_offset in NEIGHBOUR_OFFSETS:
+            r_index = r + r_offset
+            g_index = g + g_offset
+            b_index = b + b_offset
+
+            # Only check valid cell indices (skip out of bounds indices)
+            valid = ((r_index >= 0) & (g_index >= 0) & (b_index >= 0) &
+                     (r_index < resolution) & (g_index < resolution) & (b_index < resolution))
+
+            # Look the neighbour up among the occupied cells
+            neighbour = self.cell_index(r_index, g_index, b_index)
+            position = np.minimum(np.searchsorted(cell_indices, neighbour), len(cell_indices) - 1)
+            occupied = valid & (cell_indices[position] == neighbour)
+
+            is_local_maximum &= ~(occupied & (hit_counts[position] > hit_counts))
+
+        # Bring the maxima into r, g, b scan order
+        position = np.flatnonzero(is_local_maximum)
+        position = position[np.lexsort((b[position], g[position], r[position]))]
+
+        return self.make_maxima(cell_indices[position], hit_counts[position], self.r_acc[position], self.g_acc[position], self.b_acc[position])
 
 class ColorCube:
     # Uses a 3d RGB histogram to find local maximas in the density distribution
     # in order to retrieve dominant colors of pixel images
-    def __init__(self, resolution=30, avoid_color=None, distinct_threshold=0.2, bright_threshold=0.6):
+    def __init__(self, resolution=30, avoid_color=None, distinct_threshold=0.2, bright_threshold=0.6, sparse=None):
 
         # Keep resolution
         self.resolution = resolution
@@ -67,165 +344,312 @@ class ColorCube:
         # Helper variable to have cell count handy
         self.cell_count = resolution * resolution * resolution
 
-        # Create cells
-        self.cells = [ CubeCell() for k in range(self.cell_count)]
+        # Only store cells with hits for high resolutions, where most cells stay empty
+        self.sparse = resolution > SPARSE_RESOLUTION if sparse is None else sparse
 
-        # Indices for neighbour cells in three dimensional grid
-        self.neighbour_indices = [
-            [ 0, 0, 0],
-            [ 0, 0, 1],
-            [ 0, 0,-1],
+        # Cells that feed() accumulates into, made on the first feed or merge
+        self.cells = None
 
-            [ 0, 1, 0],
-            [ 0, 1, 1],
-            [ 0, 1,-1],
+        # Cells for single image analysis (get_colors, get_dominant and find_local_maxima).
+        # Every thread gets its own, so one cube can analyse images in many threads at once.
+        self.thread_state = threading.local()
 
-            [ 0,-1, 0],
-            [ 0,-1, 1],
-            [ 0,-1,-1],
+    def new_cells(self):
+        return SparseCells(self.resolution) if self.sparse else DenseCells(self.resolution)
 
-            [ 1, 0, 0],
-            [ 1, 0, 1],
-            [ 1, 0,-1],
+    def analysis_cells(self):
+        # Returns the cleared cells of the current thread, creating them on first use
+        cells = getattr(self.thread_state, 'cells', None)
 
-            [ 1, 1, 0],
-            [ 1, 1, 1],
-            [ 1, 1,-1],
+        if cells is None:
+            cells = self.thread_state.cells = self.new_cells()
+        else:
+            cells.clear()
 
-            [ 1,-1, 0],
-            [ 1,-1, 1],
-            [ 1,-1,-1],
-
-            [-1, 0, 0],
-            [-1, 0, 1],
-            [-1, 0,-1],
-
-            [-1, 1, 0],
-            [-1, 1, 1],
-            [-1, 1,-1],
-
-            [-1,-1, 0],
-            [-1,-1, 1],
-            [-1,-1,-1]
-        ]
+        return cells
 
     def cell_index(self, r, g, b):
         # Returns linear index for cell with given 3d index
         return (r+g*self.resolution+b*self.resolution*self.resolution)
 
+    def feed_cells(self):
+        # Returns the cells that feed() accumulates into, creating them on first use
+        if self.cells is None:
+            self.cells = self.new_cells()
+
+        return self.cells
+
     def clear_cells(self):
-        for c in self.cells:
-            c.hit_count = 0
-            c.r_acc = 0.0
-            c.g_acc = 0.0
-            c.b_acc = 0.0
+        if self.cells is not None:
+            self.cells.clear()
 
     def get_colors(self, image):
-        m = self.find_local_maxima(image)
+        return self.filter_colors(self.find_local_maxima(image))
+
+    def settings(self):
+        # Returns the arguments needed to create an equally configured color cube
+        return {
+            'resolution': self.resolution,
+            'avoid_color': self.avoid_color,
+            'distinct_threshold': self.distinct_threshold,
+            'bright_threshold': self.bright_threshold,
+            'sparse': self.sparse
+        }
+
+    def image_item(self, image):
+        # Returns a (mode, size, pixel bytes) tuple for the image, see open_item
+        image = self.rgb_image(image)
+        return image.mode, image.size, image.tobytes()
+
+    def image_job(self, image, size=None):
+        # Returns an (item, size, error) job for a PIL image or an image file path.
+        # Images are sent as raw pixel bytes, if that fails the job only carries the error.
+        try:
+            return (self.image_item(image) if isinstance(image, Image.Image) else image), size, None
+
+        except Exception as e:
+            return None, size, '{}: {}'.format(type(e).__name__, e)
+
+    def open_item(self, item, size=None):
+        # Returns the image for an image file path or a (mode, size, pixel bytes) tuple,
+        # scaled down to size x size if a size is given
+        if isinstance(item, tuple):
+            image = Image.frombytes(*item)
+        else:
+            image = Image.open(item)
+
+        if size:
+            image = image.resize((size, size))
+
+        return image
+
+    def iter_colors_many(self, images, workers=None, size=None):
+        # Yields (colors, error) for each of the given PIL images or image file paths, in input order.
+        # The images are spread over a pool of worker processes (one per CPU unless specified).
+        # If an image fails, colors is None and error describes the problem, the other images carry on.
+        # Images are scaled down to size x size first if a size is given.
+
+        jobs = (self.image_job(image, size) for image in images)
+
+        if workers == 1:
+            for job in jobs:
+                yield _job_colors(self, job)
+
+            return
+
+        with Pool(workers or os.cpu_count(), initializer=_init_worker, initargs=(self.settings(),)) as pool:
+            yield from pool.imap(_worker_colors, jobs)
+
+    def get_colors_many(self, images, workers=None, size=None):
+        # Returns a list of (colors, error) for each of the given images, see iter_colors_many
+        return list(self.iter_colors_many(images, workers, size))
+
+    def feed(self, pixels, mode=None):
+        # Adds a chunk of pixels to the cube without clearing it first, so an image
+        # can be analysed in rows, tiles or bands, and several images can be combined.
+        # Unlike get_colors, feeding is not meant to be shared between threads.
+        # Pixels can be a PIL image, an array with 3 (RGB) or 4 (RGBA) values per pixel,
+        # or a raw byte buffer of 8 bit pixel values in the given mode ('RGB' or 'RGBA').
+        # Call finalize() to get the colors and clear_cells() to start over.
+        if isinstance(pixels, Image.Image):
+            pixels = self.pixel_array(pixels)
+
+        elif isinstance(pixels, (bytes, bytearray, memoryview)):
+            if mode not in ('RGB', 'RGBA'):
+                raise ValueError('Raw pixel buffers need mode RGB or RGBA, got {}'.format(mode))
+
+            pixels = np.frombuffer(pixels, dtype=np.uint8).reshape(-1, len(mode))
+
+        else:
+            pixels = np.asarray(pixels, dtype=np.uint8)
+            pixels = pixels.reshape(-1, pixels.shape[-1])
+
+        self.add_pixels(pixels, self.feed_cells())
+
+    def feed_image(self, image, band_height=64):
+        # Adds an image band by band, so only one band of pixels is converted to RGB
+        # and held as an array at a time. PIL still decodes the whole image on the
+        # first crop, so this bounds the memory of the conversion, not of decoding.
+        # To bound that as well, feed() bands of pixels from your own decoder.
+        for top in range(0, image.size[1], band_height):
+            self.feed(image.crop((0, top, image.size[0], min(top + band_height, image.size[1]))))
+
+    def merge(self, other):
+        # Adds the cells of another color cube with the same resolution to this one
+        if other.resolution != self.resolution:
+            raise ValueError('Cannot merge color cubes with resolutions {} and {}'.format(self.resolution, other.resolution))
+
+        if other.cells is not None:
+            self.feed_cells().add_cells(*other.cells.occupied())
+
+    def finalize(self):
+        # Returns the colors of everything fed into the cube so far
+        if self.cells is None:
+            return []
+
+        return self.filter_colors(self.cells.iter_local_maxima())
+
+    def get_dominant(self, image, k=1):
+        # Returns the first k colors get_colors would return for the image,
+        # without filtering the maxima that come after them
+        cells = self.analysis_cells()
+        self.add_pixels(self.pixel_array(image), cells)
+
+        return self.filter_colors(cells.iter_local_maxima(), k)
+
+    def sample_colors(self, image, pixel_budget=None, time_budget=None, top=SAMPLE_TOP):
+        # Returns (colors, stability) for a deterministic, stratified sample of the pixels of the image.
+        # The image is split into blocks and every pass adds one pixel of each block, at a jittered
+        # position that differs per pass, until the pixel budget or the time budget (in seconds) is
+        # used up. Without a time budget the pixel budget defaults to SAMPLE_PIXELS.
+        # Stability is the share of the top colors that are close to a top color of the pass before,
+        # so 1.0 means more pixels would most likely not change them. Images that fit into the
+        # pixel budget are analysed completely and are always stable.
+        pixels = np.asarray(self.rgb_image(image))
+        height, width, bands = pixels.shape
+
+        if pixel_budget is None and time_budget is None:
+            pixel_budget = SAMPLE_PIXELS
+
+        cells = self.analysis_cells()
+
+        if height * width <= (pixel_budget or SAMPLE_PIXELS):
+            self.add_pixels(pixels.reshape(-1, bands), cells)
+            return self.filter_colors(cells.iter_local_maxima()), 1.0
+
+        # Size blocks so that SAMPLE_PASSES passes fit into the pixel budget
+        step = int(math.ceil(math.sqrt(height * width * SAMPLE_PASSES / float(pixel_budget or SAMPLE_PIXELS))))
+        block_y, block_x = np.mgrid[0:height:step, 0:width:step]
+        block_y, block_x = block_y.ravel(), block_x.ravel()
+
+        # Position of the first sample in each block, the same for every run
+        start = np.random.default_rng(0).integers(0, step * step, size=block_y.size)
+
+        started = time.perf_counter()
+        sampled = 0
+        previous = None
+        stability = 0.0
+
+        for n in range(step * step):
+            # Every pass moves on to the next position in each block, so no pixel is sampled twice
+            offset_y, offset_x = np.divmod((start + n) % (step * step), step)
+            y = block_y + offset_y
+            x = block_x + offset_x
+            inside = (y < height) & (x < width)
+
+            self.add_pixels(pixels[y[inside], x[inside]], cells)
+            sampled += int(inside.sum())
+
+            current = self.filter_colors(cells.iter_local_maxima(), top)
+            if previous is not None:
+                stability = self.color_stability(previous, current)
+            previous = current
+
+            if pixel_budget is not None and sampled + block_y.size > pixel_budget:
+                break
+
+            if time_budget is not None and time.perf_counter() - started >= time_budget:
+                break
+
+        return self.filter_colors(cells.iter_local_maxima()), stability
+
+    def color_stability(self, previous, current):
+        # Returns the share of the current colors that are close to one of the previous colors
+        if not current:
+            return 1.0
+
+        stable = 0
+        for c in current:
+            for p in previous:
+                delta = math.sqrt(sum((float(c[i]) - float(p[i])) ** 2 for i in range(3))) / 255.0
+                if delta < STABLE_DISTANCE:
+                    stable += 1
+                    break
+
+        return stable / float(len(current))
 
-        if not self.avoid_color is None:
-            m = self.filter_too_similar(m)
+    def filter_colors(self, maxima, k=None):
+        # Filters the specified local maxima and returns their colors as [r, g, b] lists,
+        # stopping after k colors if k is given
 
-        m = self.filter_distinct_maxima(m)
+        if k is not None and k <= 0:
+            return []
 
         colors = []
-        for n in m:
+        for n in self.iter_filtered_maxima(maxima):
             r = int(n.r*255.0)
             g = int(n.g*255.0)
             b = int(n.b*255.0)
             colors.append([r, g, b])
 
-        return colors
-
-    def find_local_maxima(self, image):
-        # Finds and returns local maxima in 3d histogram, sorted with respect to hit count
+            if k is not None and len(colors) >= k:
+                break
 
-        # Reset all cells
-        self.clear_cells()
+        return colors
 
-        # Iterate over all pixels of the image
-        for p in image.getdata():
+    def iter_filtered_maxima(self, maxima):
+        # Yields the maxima that are far enough away from the avoid color and distinct
+        # from all maxima before them, one at a time, in the order they are given
 
-            # Get color components
-            r = float(p[0])/255.0
-            g = float(p[1])/255.0
-            b = float(p[2])/255.0
+        avoid = self.avoid_grid()
+        result = ColorGrid(self.distinct_threshold)
 
-            if r < self.bright_threshold and g < self.bright_threshold and b < self.bright_threshold:
+        for m in maxima:
+            if avoid is not None and avoid.has_near(m):
                 continue
 
-            # If image has alpha channel, weight colors by it
-            if len(p) == 4:
-                a = float(p[3])/255.0
-                r *= a
-                g *= a
-                b *= a
+            if not result.has_near(m):
+                result.add(m)
+                yield m
 
-            # Map color components to cell indices in each color dimension
-            r_index = int(r*(float(self.resolution)-1.0))
-            g_index = int(g*(float(self.resolution)-1.0))
-            b_index = int(b*(float(self.resolution)-1.0))
+    def rgb_image(self, image):
+        # Returns the image in RGB mode, or RGBA mode for images with an alpha channel
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
 
-            # Compute linear cell index
-            index = self.cell_index(r_index, g_index, b_index)
+        return image
 
-            # Increase hit count of cell
-            self.cells[index].hit_count += 1
+    def pixel_array(self, image):
+        # Returns the pixels of the image as an (n, bands) array of 8 bit values,
+        # with 3 bands for plain images and 4 bands for images with an alpha channel
+        pixels = np.asarray(self.rgb_image(image))
 
-            # Add pixel colors to cell color accumulators
-            self.cells[index].r_acc += r
-            self.cells[index].g_acc += g
-            self.cells[index].b_acc += b
+        return pixels.reshape(-1, pixels.shape[-1])
 
-        # We collect local maxima in here
-        local_maxima = []
+    def add_pixels(self, pixels, cells):
+        # Adds an (n, 3) or (n, 4) array of 8 bit pixel values to the given cells
 
-        # Find local maxima in the grid
-        for r in range(self.resolution):
-            for g in range(self.resolution):
-                for b in range(self.resolution):
-
-                    local_index = self.cell_index(r, g, b)
+        # Get color components
+        colors = pixels[:, :3] / 255.0
 
-                    # Get hit count of this cell
-                    local_hit_count = self.cells[local_index].hit_count
+        # Drop pixels that are darker than the threshold in every component
+        bright = (colors >= self.bright_threshold).any(axis=1)
+        colors = colors[bright]
 
-                    # If this cell has no hits, ignore it (we are not interested in zero hit cells)
-                    if local_hit_count == 0:
-                        continue
+        # If image has alpha channel, weight colors by it
+        if pixels.shape[1] == 4:
+            colors *= (pixels[bright, 3] / 255.0)[:, np.newaxis]
 
-                    # It is a local maximum until we find a neighbour with a higher hit count
-                    is_local_maximum = True
+        # Map color components to cell indices in each color dimension
+        indices = (colors * (float(self.resolution) - 1.0)).astype(np.intp)
 
-                    # Check if any neighbour has a higher hit count, if so, no local maxima
+        # Compute linear cell indices
+        index = self.cell_index(indices[:, 0], indices[:, 1], indices[:, 2])
 
-                    for n in range(27):
-                        r_index = r+self.neighbour_indices[n][0]
-                        g_index = g+self.neighbour_indices[n][1]
-                        b_index = b+self.neighbour_indices[n][2]
+        # Increase hit counts and add pixel colors to cell color accumulators
+        cells.add(index, colors)
 
-                        # Only check valid cell indices (skip out of bounds indices)
-
-                        if r_index >= 0 and g_index >= 0 and b_index >= 0:
-                            if r_index < self.resolution and g_index < self.resolution and b_index < self.resolution:
-                                if self.cells[self.cell_index(r_index, g_index, b_index)].hit_count > local_hit_count:
-                                    # Neighbour hit count is higher, so this is NOT a local maximum.
-                                    is_local_maximum = False
-                                    # Break inner loop
-                                    break
+    def find_local_maxima(self, image):
+        # Finds and returns local maxima in 3d histogram, sorted with respect to hit count
 
-                    # If this is not a local maximum, continue with loop.
-                    if is_local_maximum == False:
-                        continue
+        # Get cleared cells for this thread
+        cells = self.analysis_cells()
 
-                    # Otherwise add this cell as local maximum
-                    avg_r = self.cells[local_index].r_acc / float(self.cells[local_index].hit_count)
-                    avg_g = self.cells[local_index].g_acc / float(self.cells[local_index].hit_count)
-                    avg_b = self.cells[local_index].b_acc / float(self.cells[local_index].hit_count)
-                    local_maxima.append(LocalMaximum(local_hit_count, local_index, avg_r, avg_g, avg_b))
+        # Add the whole pixel buffer at once
+        self.add_pixels(self.pixel_array(image), cells)
 
-        # Return local maxima sorted with respect to hit count
-        return sorted(local_maxima, key=lambda x: x.hit_count, reverse=True)
+        # Find local maxima in the grid
+        return list(cells.iter_local_maxima())
 
     def filter_distinct_maxima(self, maxima):
         # Returns a filtered version of the specified array of maxima,
@@ -233,27 +657,13 @@ class ColorCube:
 
         result = []
 
-        # Check for each maximum
-        for m in maxima:
-            # This color is distinct until a color from before is too close
-            is_distinct = True
+        # Colors accepted so far, for looking up close ones
+        accepted = ColorGrid(self.distinct_threshold)
 
-            for n in result:
-                # Compute delta components
-                r_delta = m.r - n.r
-                g_delta = m.g - n.g
-                b_delta = m.b - n.b
-
-                # Compute delta in color space distance
-                delta = math.sqrt(r_delta*r_delta + g_delta*g_delta + b_delta*b_delta)
-
-                # If too close mark as non-distinct and break inner loop
-                if delta < self.distinct_threshold:
-                    is_distinct = False
-                    break
-
-            # Add to filtered array if is distinct
-            if is_distinct == True:
+        # Check for each maximum, add to filtered array if no color from before is too close
+        for m in maxima:
+            if not accepted.has_near(m):
+                accepted.add(m)
                 result.append(m)
 
         return result
@@ -262,46 +672,178 @@ class ColorCube:
         # Returns a filtered version of the specified array of maxima,
         # in which all entries are far enough away from the specified avoid_color
 
-        result = []
+        avoid = self.avoid_grid()
 
-        ar = float(self.avoid_color[0])/255.0
-        ag = float(self.avoid_color[1])/255.0
-        ab = float(self.avoid_color[2])/255.0
+        return [m for m in maxima if not avoid.has_near(m)]
 
-        # Check for each maximum
-        for m in maxima:
+    def avoid_grid(self):
+        # Returns a color grid holding the avoid color, or None if there is no avoid color
+        if self.avoid_color is None:
+            return None
 
-            # Compute delta components
-            r_delta = m.r - ar
-            g_delta = m.g - ag
-            b_delta = m.b - ab
+        avoid = ColorGrid(AVOID_DISTANCE)
+        avoid.add(LocalMaximum(0, -1,
+                               float(self.avoid_color[0])/255.0,
+                               float(self.avoid_color[1])/255.0,
+                               float(self.avoid_color[2])/255.0))
 
-            # Compute delta in color space distance
-            delta = math.sqrt(r_delta*r_delta + g_delta*g_delta + b_delta*b_delta)
+        return avoid
 
-            if delta >= 0.5:
-                result.append(m)
+class PaletteCache:
+    # Remembers the colors a color cube found for images, keyed by a hash of the
+    # image content, the cube settings and the sampling parameters if sampled. The most recently used entries are kept
+    # in memory, and if a directory is given every entry is also stored there as a
+    # JSON file, so it survives between runs.
+    def __init__(self, cube, max_entries=1024, path=None):
+        self.cube = cube
+        self.max_entries = max_entries
+        self.path = path
+
+        # Cache statistics
+        self.hits = 0
+        self.misses = 0
+
+        # Entries in order of use, least recently used first
+        self.entries = OrderedDict()
+
+        # Guards entries and statistics when the cache is shared between threads
+        self.lock = threading.Lock()
+
+        if path:
+            os.makedirs(path, exist_ok=True)
+
+    def key(self, image, parameters=None):
+        # Returns the cache key for a PIL image, an image file path or encoded image bytes.
+        # Files and encoded bytes are hashed as they are, so they don't need to be decoded.
+        # Parameters of the analysis other than the cube settings are part of the key if given.
+        digest = hashlib.sha256(json.dumps(self.cube.settings(), sort_keys=True).encode())
+
+        if parameters is not None:
+            digest.update(json.dumps(parameters, sort_keys=True).encode())
+
+        if isinstance(image, Image.Image):
+            digest.update('{} {}'.format(image.mode, image.size).encode())
+            digest.update(image.tobytes())
+
+        elif isinstance(image, (bytes, bytearray)):
+            digest.update(image)
+
+        else:
+            with open(image, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 16), b''):
+                    digest.update(block)
+
+        return digest.hexdigest()
+
+    def get_colors(self, image):
+        # Returns the colors for a PIL image, an image file path or encoded image bytes
+        return self.cached(image, None, self.cube.get_colors)
+
+    def sample_colors(self, image, pixel_budget=None, time_budget=None, top=SAMPLE_TOP):
+        # Returns (colors, stability) like ColorCube.sample_colors, for a PIL image,
+        # an image file path or encoded image bytes
+        parameters = {'sample': [pixel_budget, time_budget, top]}
+
+        colors, stability = self.cached(image, parameters, lambda image: list(self.cube.sample_colors(image, pixel_budget, time_budget, top)))
+
+        return colors, stability
+
+    def cached(self, image, parameters, analyse):
+        # Returns the cached result for the image and parameters, or the result of
+        # analyse(image), which is stored. Results need to survive a trip through JSON.
+        key = self.key(image, parameters)
+
+        result = self.lookup(key)
+
+        with self.lock:
+            if result is not None:
+                self.hits += 1
+                return result
+
+            self.misses += 1
+
+        if isinstance(image, (bytes, bytearray)):
+            image = Image.open(BytesIO(image))
+        elif not isinstance(image, Image.Image):
+            image = Image.open(image)
+
+        result = analyse(image)
+        self.store(key, result)
 
         return result
 
+    def lookup(self, key):
+        # Returns the cached colors for the key, or None
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        if self.path:
+            try:
+                with open(os.path.join(self.path, key + '.json')) as f:
+                    colors = json.load(f)
+
+            except (OSError, ValueError):
+                return None
+
+            self.remember(key, colors)
+            return colors
+
+        return None
+
+    def store(self, key, colors):
+        self.remember(key, colors)
+
+        if self.path:
+            # Write to a temporary file first, so readers never see half written entries
+            filename = os.path.join(self.path, key + '.json')
+            temporary = '{}.{}.{}.tmp'.format(filename, os.getpid(), threading.get_ident())
+            with open(temporary, 'w') as f:
+                json.dump(colors, f)
+            os.replace(temporary, filename)
+
+    def remember(self, key, colors):
+        # Keeps the entry in memory, dropping the least recently used entries if full
+        with self.lock:
+            self.entries[key] = colors
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
 ################################################################################
 # Command line example
 if __name__ == "__main__":
     import argparse
-    parser = argparse.ArgumentParser(description='Get dominant colors of an image.')
-    parser.add_argument('image', help='Image file to process.')
+    parser = argparse.ArgumentParser(description='Get dominant colors of images, printed as one JSON line per image.')
+    parser.add_argument('images', nargs='+', help='Image files or directories of image files to process.')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes (default: one per CPU).')
     args = parser.parse_args()
 
+    # Expand directories into the image files they contain
+    paths = []
+    for path in args.images:
+        if os.path.isdir(path):
+            paths += sorted(os.path.join(path, name) for name in os.listdir(path)
+                            if name.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')))
+        else:
+            paths.append(path)
+
     # Create color cube, avoiding resulting colors that are too close to white.
     cc = ColorCube(avoid_color=[255, 255, 255])
 
-    # Load image and scale down to make the algorithm faster.
+    # Load images and scale down to make the algorithm faster.
     # Scaling down also gives colors that are more dominant in perception.
-    image = Image.open(args.image).resize((50, 50))
-
-    # Get colors for that image
-    colors = cc.get_colors(image)
-
-    # Print first four colors (there might be much more)
-    for c in colors[:10]:
-        print(c)
+    results = cc.iter_colors_many(paths, workers=args.workers, size=50)
+
+    # Print the colors of each image as soon as they are ready
+    for path, (colors, error) in zip(paths, results):
+        if error is None:
+            print(json.dumps({'image': path, 'colors': colors}), flush=True)
+        else:
+            print(json.dumps({'image': path, 'error': error}), flush=True)
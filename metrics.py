@@ -0,0 +1,127 @@
+import os
+import json
+import functools
+import threading
+
+from time import monotonic, time
+from contextlib import contextmanager
+
+# What is recorded for every step or helper
+FIELDS = ['calls', 'seconds', 'errors', 'bytes', 'retries']
+
+# Prometheus help text for each field
+HELP = {
+    'calls': 'Number of times the step ran',
+    'seconds': 'Wall time spent in the step',
+    'errors': 'Number of times the step failed',
+    'bytes': 'Bytes downloaded by the step',
+    'retries': 'Number of retries made by the step'
+}
+
+class Metrics:
+    # Collects wall time, calls, bytes, retries and errors by name over a run,
+    # and writes them out as a JSON report and a Prometheus textfile
+    def __init__(self, prefix):
+        # prefix is put in front of the Prometheus metric names
+        self.prefix = prefix
+        self.started = time()
+        self.steps = {}
+        self.lock = threading.Lock()
+
+    def step(self, name):
+        if name not in self.steps:
+            self.steps[name] = dict.fromkeys(FIELDS, 0)
+
+        return self.steps[name]
+
+    def count(self, name, field, amount=1):
+        with self.lock:
+            self.step(name)[field] += amount
+
+    @contextmanager
+    def timer(self, name):
+        # Times the block as one call of name, and counts it as an error if it raises
+        started = monotonic()
+        failed = False
+
+        try:
+            yield
+
+        except BaseException:
+            failed = True
+            raise
+
+        finally:
+            with self.lock:
+                step = self.step(name)
+                step['calls'] += 1
+                step['seconds'] += monotonic() - started
+                step['errors'] += failed
+
+    def timed(self, name):
+        # Decorator that times every call of the function as name
+        def decorate(function):
+            @functools.wraps(function)
+            def timed(*args, **kwargs):
+                with self.timer(name):
+                    return function(*args, **kwargs)
+
+            return timed
+
+        return decorate
+
+    def report(self, **extra):
+        # Returns the metrics as a dict, with anything in extra added on
+        with self.lock:
+            report = {
+                'started': self.started,
+                'seconds': time() - self.started,
+                'steps': {name: dict(step) for name, step in sorted(self.steps.items())}
+            }
+
+        report.update(extra)
+
+        return report
+
+    def textfile(self):
+        # Returns the metrics in the Prometheus text format. Every file holds a single
+        # run, so the values are gauges for that run rather than running counters.
+        lines = []
+
+        with self.lock:
+            steps = sorted(self.steps.items())
+
+        for field in FIELDS:
+            metric = '{}_step_{}'.format(self.prefix, field)
+            lines.append('# HELP {} {}'.format(metric, HELP[field]))
+            lines.append('# TYPE {} gauge'.format(metric))
+
+            for name, step in steps:
+                lines.append('{}{{step="{}"}} {}'.format(metric, name.replace('\\', '\\\\').replace('"', '\\"'), step[field]))
+
+        for metric, help, value in [
+            ('{}_run_started_timestamp_seconds'.format(self.prefix), 'When the run started', self.started),
+            ('{}_run_seconds'.format(self.prefix), 'Wall time of the run', time() - self.started)
+        ]:
+            lines += ['# HELP {} {}'.format(metric, help), '# TYPE {} gauge'.format(metric), '{} {}'.format(metric, value)]
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, report_path=None, textfile_path=None, **extra):
+        # Writes the JSON report and the Prometheus textfile. Both are written to a
+        # temporary file first, so a collector never reads a half written file.
+        for path, content in [
+            (report_path, lambda: json.dumps(self.report(**extra), indent=2, default=str)),
+            (textfile_path, self.textfile)
+        ]:
+            if not path:
+                continue
+
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            temporary = '{}.{}.tmp'.format(path, os.getpid())
+            with open(temporary, 'w') as f:
+                f.write(content())
+
+            os.replace(temporary, path)
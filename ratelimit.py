@@ -0,0 +1,104 @@
+import threading
+
+from time import monotonic, sleep, time
+
+class TokenBucket:
+    # Allows bursts of up to capacity calls, refilled at rate calls per second.
+    # Services that tell us their remaining quota get calls at that pace until
+    # the quota is used up, and then none until it resets.
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = float(capacity)
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+        # Calls left in the quota the service reported, and when (on the monotonic clock) it resets
+        self.remaining = None
+        self.reset_at = None
+
+    def refill(self):
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        # Takes a token, waiting for one if needed. Returns the seconds spent waiting.
+        waited = 0.0
+
+        while True:
+            with self.lock:
+                now = monotonic()
+
+                if self.reset_at is not None and now >= self.reset_at:
+                    self.remaining = self.reset_at = None
+
+                if self.remaining is not None and self.remaining < 1:
+                    # Quota used up, wait for the reset
+                    delay = self.reset_at - now
+
+                else:
+                    self.refill()
+
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+
+                        # Count the call against the quota before the service does, so
+                        # calls made while others are in flight don't overdraw it
+                        if self.remaining is not None:
+                            self.remaining -= 1
+
+                        return waited
+
+                    delay = (1 - self.tokens) / self.rate
+
+            sleep(delay)
+            waited += delay
+
+    def limit(self, remaining, reset):
+        # The service allows remaining more calls in the next reset seconds
+        with self.lock:
+            self.remaining = remaining
+            self.reset_at = monotonic() + max(reset, 0.0)
+
+class Scheduler:
+    # Every outbound call of the bot takes a token from the bucket of its service
+    # first, so we slow down before a service starts refusing us
+    def __init__(self, limits):
+        # limits maps service names to (capacity, calls per second) to start with
+        self.buckets = {service: TokenBucket(*limit) for service, limit in limits.items()}
+        self.stats = {service: {'calls': 0, 'waited': 0.0, 'remaining': None} for service in limits}
+        self.lock = threading.Lock()
+
+    def acquire(self, service):
+        waited = self.buckets[service].acquire()
+
+        with self.lock:
+            self.stats[service]['calls'] += 1
+            self.stats[service]['waited'] += waited
+
+    def limit(self, service, remaining, reset):
+        # Feeds the quota a service reported in its response headers into its bucket.
+        # Missing or broken headers are ignored.
+        try:
+            remaining, reset = float(remaining), float(reset)
+
+        except (TypeError, ValueError):
+            return
+
+        self.buckets[service].limit(remaining, reset)
+
+        with self.lock:
+            self.stats[service]['remaining'] = remaining
+
+    def limit_until(self, service, remaining, reset_at):
+        # Like limit, with the reset given as a unix timestamp
+        try:
+            self.limit(service, remaining, float(reset_at) - time())
+
+        except (TypeError, ValueError):
+            return
+
+    def report(self):
+        with self.lock:
+            return {service: dict(stats) for service, stats in self.stats.items()}
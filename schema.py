@@ -0,0 +1,158 @@
+################################################################################
+# Collections and their indexes
+#
+# Shared by the web app and the bot, which both ensure the indexes when they
+# connect. Creating an index that already exists does nothing, so this is
+# cheap to do on every start. Indexes keep their default names, so the ones
+# made before this module existed are recognised.
+#
+# Run as a script to check that the queries the web app and the bot run on
+# every page view or sync are answered from an index. The check runs against
+# a scratch database, and fails if any of them plans a full collection scan:
+#
+#   python schema.py --uri mongodb://localhost:27017
+
+import argparse
+import sys
+
+from pymongo import MongoClient, IndexModel, UpdateOne, DeleteMany, ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+from bson.objectid import ObjectId
+
+INDEXES = {
+    # The web app looks up and upserts the vote of the logged in user, one vote per user
+    'votes': [IndexModel([('id', ASCENDING)], unique=True)],
+
+    # The voting page and /admin list submissions by title, the bot syncs them by reddit id.
+    # Submissions stored before they had a reddit id get one on the next sync, so it isn't unique.
+    'submissions': [
+        IndexModel([('title', ASCENDING)]),
+        IndexModel([('reddit_id', ASCENDING)])
+    ],
+
+    # Vote counts are read most votes first
+    'tallies': [IndexModel([('count', DESCENDING)])],
+
+    # Resolved image links are removed at the time stored with them
+    'image_cache': [IndexModel([('expires', ASCENDING)], expireAfterSeconds=0)]
+}
+
+# The queries that run on every page view, vote or sync, with made up values
+HOT_QUERIES = {
+    'vote of a user': lambda db: db.votes.find({"id": "abc123"}),
+    'submissions by title': lambda db: db.submissions.find({"removed": {"$ne": True}}).sort("title", ASCENDING),
+    'submission by id': lambda db: db.submissions.find({"_id": ObjectId(), "removed": {"$ne": True}}),
+    'submission by reddit id': lambda db: db.submissions.find({"reddit_id": "abc123"}),
+    'tallies by count': lambda db: db.tallies.find({"count": {"$gt": 0}}).sort("count", DESCENDING),
+    'cached image': lambda db: db.image_cache.find({"_id": "https://imgur.com/abc123"})
+}
+
+def ensure_indexes(db):
+    # Creates the indexes that don't exist yet. An index that can't be made, like the
+    # unique votes index while there are duplicate votes, is reported and skipped,
+    # so the web app still starts. remove_duplicate_votes clears the way for it.
+    for collection, indexes in INDEXES.items():
+        try:
+            db.get_collection(collection).create_indexes(indexes)
+
+        except OperationFailure as e:
+            print('ERROR: could not create the indexes of {}: {}'.format(collection, e), file=sys.stderr)
+
+def remove_duplicate_votes(db):
+    # Keeps one vote per user, the oldest, which is the one the web app has been
+    # reading and updating. Returns the number of votes removed.
+    duplicates = db.votes.aggregate([
+        {"$sort": {"_id": ASCENDING}},
+        {
+            "$group": {
+                "_id": "$id",
+                "votes": {"$push": "$_id"},
+                "count": {"$sum": 1}
+            }
+        },
+        {"$match": {"count": {"$gt": 1}}}
+    ], allowDiskUse=True)
+
+    operations = [DeleteMany({"_id": {"$in": user["votes"][1:]}}) for user in duplicates]
+
+    if not operations:
+        return 0
+
+    return db.votes.bulk_write(operations, ordered=False).deleted_count
+
+def rebuild_tallies(db):
+    # Counts the votes again and makes db.tallies match. Votes cast while this
+    # runs can be missed, so run it while voting is closed, or run it twice.
+    # Returns the result of the write.
+    counts = {vote["_id"]: vote["count"] for vote in db.votes.aggregate([
+        {
+            "$group": {
+                "_id": "$vote",
+                "count": {"$sum": 1}
+            }
+        }
+    ])}
+
+    operations = [UpdateOne({"_id": vote}, {"$set": {"count": count}}, upsert=True) for vote, count in counts.items()]
+    operations.append(DeleteMany({"_id": {"$nin": list(counts)}}))
+
+    return db.tallies.bulk_write(operations, ordered=False)
+
+def ensure_tallies(db):
+    # Counts the votes into db.tallies if there are votes but no tallies yet,
+    # like on the first start after the tallies were introduced
+    if db.tallies.estimated_document_count() == 0 and db.votes.estimated_document_count() > 0:
+        rebuild_tallies(db)
+
+def plan_stages(plan):
+    # Returns the names of all stages of an explain plan, however deeply nested
+    if isinstance(plan, dict):
+        stages = [plan['stage']] if isinstance(plan.get('stage'), str) else []
+
+        for value in plan.values():
+            stages += plan_stages(value)
+
+        return stages
+
+    if isinstance(plan, list):
+        return [stage for value in plan for stage in plan_stages(value)]
+
+    return []
+
+def check_plans(db):
+    # Returns a list of problems with the plans of the hot queries
+    problems = []
+
+    for name, query in HOT_QUERIES.items():
+        stages = plan_stages(query(db).explain()['queryPlanner']['winningPlan'])
+
+        if 'COLLSCAN' in stages:
+            problems.append('{}: full collection scan ({})'.format(name, ' < '.join(stages)))
+
+    return problems
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check that the hot queries use an index.')
+    parser.add_argument('--uri', default='mongodb://localhost:27017', help='MongoDB to check against.')
+    parser.add_argument('--db', default='lowpoly_plans', help='Scratch database to check in, dropped afterwards if it is new.')
+    args = parser.parse_args()
+
+    client = MongoClient(args.uri)
+    existed = args.db in client.list_database_names()
+    db = client[args.db]
+
+    try:
+        ensure_indexes(db)
+        problems = check_plans(db)
+
+    finally:
+        if not existed:
+            client.drop_database(args.db)
+
+    for problem in problems:
+        print(problem, file=sys.stderr)
+
+    if problems:
+        sys.exit(1)
+
+    print('All {} queries use an index'.format(len(HOT_QUERIES)))
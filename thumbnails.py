@@ -0,0 +1,77 @@
+import os
+import base64
+import hashlib
+import threading
+
+from io import BytesIO
+from PIL import Image
+
+# Where the bot writes thumbnails and the web app serves them from
+THUMBNAIL_DIR = os.environ.get("THUMBNAIL_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'thumbnails'))
+
+# Widths the voting gallery picks from, a column is a third to a half of the screen
+THUMBNAIL_WIDTHS = [320, 640]
+
+# File extension: (PIL format, save options)
+THUMBNAIL_FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 6}),
+    'jpg': ('JPEG', {'quality': 85, 'optimize': True, 'progressive': True})
+}
+
+# Width of the placeholder shown while a thumbnail loads, it is stretched so it comes out blurry
+PLACEHOLDER_WIDTH = 16
+
+def thumbnail_name(key, width, ext):
+    # Thumbnails are content addressed, so a file never changes once written
+    return '{}/{}-{}.{}'.format(key[:2], key, width, ext)
+
+def make_thumbnails(data):
+    # Writes thumbnails of the encoded image in every width and format.
+    # Returns the fields to store with the submission: the content key of the image,
+    # the widths that were written, the size of the image and a placeholder data URI.
+    key = hashlib.sha256(data).hexdigest()
+
+    image = Image.open(BytesIO(data))
+    size = image.size
+
+    # Never scale up, small images get a single thumbnail at their own width
+    widths = sorted(set(min(width, image.size[0]) for width in THUMBNAIL_WIDTHS))
+
+    # Let JPEGs decode at a reduced size if that is still big enough for the largest thumbnail
+    image.draft('RGB', (widths[-1], image.size[1] * widths[-1] // image.size[0]))
+    image = image.convert('RGB')
+
+    for width in widths:
+        height = max(1, round(image.size[1] * width / float(image.size[0])))
+        thumbnail = image.resize((width, height), Image.LANCZOS)
+
+        for ext, (format, options) in THUMBNAIL_FORMATS.items():
+            filename = os.path.join(THUMBNAIL_DIR, thumbnail_name(key, width, ext))
+
+            if os.path.exists(filename):
+                continue
+
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+            # Write to a temporary file first, so the web app never serves half written files.
+            # Threads of the bot can write the same image at once, so it is named per thread.
+            temporary = '{}.{}.{}.tmp'.format(filename, os.getpid(), threading.get_ident())
+            thumbnail.save(temporary, format=format, **options)
+            os.replace(temporary, filename)
+
+    return {
+        'thumbnail': key,
+        'thumbnail_widths': widths,
+        'width': size[0],
+        'height': size[1],
+        'placeholder': make_placeholder(image)
+    }
+
+def make_placeholder(image):
+    # Returns a tiny JPEG of the image as a data URI, a few hundred bytes that can go right into the page
+    height = max(1, round(image.size[1] * PLACEHOLDER_WIDTH / float(image.size[0])))
+    placeholder = image.convert('RGB').resize((PLACEHOLDER_WIDTH, height), Image.BOX)
+
+    with BytesIO() as f:
+        placeholder.save(f, format='JPEG', quality=50)
+        return 'data:image/jpeg;base64,' + base64.b64encode(f.getvalue()).decode('ascii')